@@ -3,4 +3,5 @@
 export RELEASE_BOT_HOME=/home/release-bot
 
 exec release-bot -c /home/release-bot/.config/conf.yaml &
-exec celery -A release_bot.celery_task worker -l info
+# tasks don't share configuration, threads/gevent/eventlet pools are safe
+exec celery -A release_bot.celery_task worker -l info --pool "${CELERY_POOL:-prefork}"
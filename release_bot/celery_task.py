@@ -13,17 +13,42 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-from pathlib import Path
+import json
+import logging
+import threading
+from contextlib import contextmanager
 from os import getenv
+
 import redis
 
 from release_bot.celerizer import celery_app
 from release_bot.exceptions import ReleaseException
-from release_bot.configuration import configuration
+from release_bot.configuration import get_base_configuration
 from release_bot.releasebot import ReleaseBot
+from release_bot.utils import get_redis_instance
 
 DEFAULT_CONF_FILE = "/home/release-bot/.config/conf.yaml"
 
+PENDING_PREFIX = "release-bot:pending:"
+SCHEDULED_PREFIX = "release-bot:scheduled:"
+LOCK_PREFIX = "release-bot:lock:"
+# events of one repository received within this many seconds are handled together
+COALESCE_WINDOW = int(getenv("COALESCE_WINDOW", "10"))
+# a lock not extended for this long is considered abandoned by a dead worker,
+# the worker holding it extends it every third of the time
+LOCK_TIMEOUT = 5 * 60
+LOCK_RETRY_DELAY = 15
+# the task gives up after waiting for the lock for about an hour,
+# its events stay pending for the next task of the repository
+MAX_RETRIES = 3600 // LOCK_RETRY_DELAY
+# a failed task is retried after LOCK_RETRY_DELAY doubled by every failure,
+# failures which repeat this many times aren't going away by themselves
+MAX_FAILURE_RETRIES = 5
+# pending events nobody picked up are dropped after this many seconds
+PENDING_TTL = 24 * 3600
+
+logger = logging.getLogger("release-bot")
+
 
 @celery_app.task(name="task.celery_task.parse_web_hook_payload")
 def parse_web_hook_payload(webhook_payload):
@@ -34,11 +59,11 @@ def parse_web_hook_payload(webhook_payload):
     db = get_redis_instance()
     if "issue" in webhook_payload.keys():
         if webhook_payload["action"] == "opened":
-            handle_issue(webhook_payload, db)
+            queue_event(webhook_payload, db)
     elif "pull_request" in webhook_payload.keys():
         if webhook_payload["action"] == "closed":
             if webhook_payload["pull_request"]["merged"] is True:
-                handle_pr(webhook_payload, db)
+                queue_event(webhook_payload, db)
     elif "installation" in webhook_payload.keys():
         # detect new repo installation
         if webhook_payload["action"] == "added":
@@ -52,64 +77,211 @@ def parse_web_hook_payload(webhook_payload):
             delete_installations(repositories_removed, db)
 
 
-def get_redis_instance():
-    db = redis.Redis(
-        host=getenv("REDIS_SERVICE_HOST", "localhost"),
-        port=getenv("REDIS_SERVICE_PORT", "6379"),
-        db=1,  # 0 is used by Celery
-        decode_responses=True,
-    )
-    return db
+def queue_event(webhook_payload, db):
+    """
+    Add the event to pending events of its repository and schedule
+    reconcile of the repository in COALESCE_WINDOW seconds, unless
+    it is scheduled already
+    :param webhook_payload: json data from webhook
+    :param db: Redis instance
+    :return: True if a new reconcile task was scheduled
+    """
+    full_name = webhook_payload["repository"]["full_name"]
+    with db.pipeline() as pipe:
+        pipe.rpush(PENDING_PREFIX + full_name, json.dumps(webhook_payload))
+        pipe.expire(PENDING_PREFIX + full_name, PENDING_TTL)
+        # expires, so that a lost task doesn't block scheduling forever
+        pipe.set(
+            SCHEDULED_PREFIX + full_name,
+            1,
+            nx=True,
+            ex=COALESCE_WINDOW + LOCK_TIMEOUT,
+        )
+        scheduled = pipe.execute()[-1]
+    if not scheduled:
+        logger.debug(f"Reconcile of {full_name} is already scheduled")
+        return False
+    reconcile_repository.apply_async(args=(full_name,), countdown=COALESCE_WINDOW)
+    return True
+
+
+def get_pending_events(full_name, db):
+    """
+    :return: list of pending events of the repository, oldest first
+    """
+    events = db.lrange(PENDING_PREFIX + full_name, 0, -1)
+    return [json.loads(event) for event in events]
+
+
+def drop_pending_events(full_name, db, count):
+    """
+    Remove the oldest count events, which have been handled,
+    events queued meanwhile stay pending
+    """
+    db.ltrim(PENDING_PREFIX + full_name, count, -1)
+
+
+@contextmanager
+def keep_lock(lock):
+    """
+    Extend the lock in the background, so that it doesn't expire
+    while a long release runs
+    """
+    stop = threading.Event()
+
+    def extend():
+        while not stop.wait(LOCK_TIMEOUT / 3):
+            try:
+                lock.reacquire()
+            except redis.RedisError as exc:
+                logger.warning(f"Couldn't extend lock {lock.name}: {exc}")
+
+    thread = threading.Thread(target=extend, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+@celery_app.task(
+    bind=True, name="task.celery_task.reconcile_repository", max_retries=MAX_RETRIES
+)
+def reconcile_repository(self, full_name, failures=0):
+    """
+    Handle all pending events of the repository at once.
+    Only one worker at a time acts on a repository,
+    the task is retried later while another one holds the lock.
+    Events are removed only when they have been handled,
+    the task is retried with exponential backoff when handling them fails.
+    :param full_name: "owner/name" of the repository
+    :param failures: how many times handling the events has failed
+    """
+    db = get_redis_instance()
+    lock = db.lock(LOCK_PREFIX + full_name, timeout=LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        logger.debug(f"{full_name} is locked by another worker, retrying later")
+        raise self.retry(countdown=LOCK_RETRY_DELAY)
+    try:
+        # events queued from now on schedule a new task which waits for the lock
+        db.delete(SCHEDULED_PREFIX + full_name)
+        events = get_pending_events(full_name, db)
+        if events:
+            logger.info(f"Handling {len(events)} events of {full_name}")
+            with keep_lock(lock):
+                handle_events(events, db)
+            drop_pending_events(full_name, db, len(events))
+    except Exception as exc:
+        logger.error(f"Handling events of {full_name} failed: {exc!r}")
+        if failures >= MAX_FAILURE_RETRIES:
+            raise
+        raise self.retry(
+            args=(full_name,),
+            kwargs={"failures": failures + 1},
+            exc=exc,
+            countdown=LOCK_RETRY_DELAY * 2 ** failures,
+        )
+    finally:
+        try:
+            lock.release()
+        except redis.exceptions.LockError:
+            logger.warning(f"Lock of {full_name} expired before it was released")
 
 
 def set_configuration(webhook_payload, db, issue=True):
     """
-    Prepare configuration from parsed web hook payload
-    and return ReleaseBot instance with logger
+    Prepare configuration of the task from the configuration file
+    and parsed web hook payload and return ReleaseBot instance with logger.
+    Every task gets its own configuration, so tasks may run in threads.
 
     :param webhook_payload: payload from web hook
     :param issue: if true parse Github issue payload otherwise parse
                   Github pull request payload
     :return: ReleaseBot instance, configuration logger
     """
-    configuration.configuration = Path(getenv("CONF_PATH", DEFAULT_CONF_FILE)).resolve()
+    base = get_base_configuration(getenv("CONF_PATH", DEFAULT_CONF_FILE))
 
     # add configuration from Github webhook
-    configuration.repository_name = webhook_payload["repository"]["name"]
-    configuration.repository_owner = webhook_payload["repository"]["owner"]["login"]
     if issue:
-        configuration.github_username = webhook_payload["issue"]["user"]["login"]
+        github_username = webhook_payload["issue"]["user"]["login"]
     else:
-        configuration.github_username = webhook_payload["pull_request"]["user"]["login"]
+        github_username = webhook_payload["pull_request"]["user"]["login"]
+    # derive() creates url for github app to enable access over http
+    conf = base.derive(
+        repository_name=webhook_payload["repository"]["name"],
+        repository_owner=webhook_payload["repository"]["owner"]["login"],
+        github_username=github_username,
+        github_app_installation_id=db.get(webhook_payload["repository"]["full_name"]),
+    )
+    return ReleaseBot(conf), conf.logger
+
 
-    repo_installation_id = db.get(webhook_payload["repository"]["full_name"])
-    configuration.github_app_installation_id = repo_installation_id
+def handle_events(events, db):
+    """
+    Handle pending events of one repository: merged PRs are released first,
+    then opened issues are resolved. Each kind is handled by one ReleaseBot
+    configured for the author of its latest event.
+    :param events: list of json data from webhooks
+    :param db: Redis instance
+    :return:
+    """
+    prs = [event for event in events if "pull_request" in event]
+    issues = [event for event in events if "issue" in event]
+    if prs:
+        handle_events_of_kind(prs, db, issue=False)
+    if issues:
+        handle_events_of_kind(issues, db, issue=True)
 
-    configuration.load_configuration()  # load the rest of configuration if there is any
 
-    # create url for github app to enable access over http
-    configuration.clone_url = (
-        f"https://x-access-token:"
-        f"{configuration.github_token}@github.com/"
-        f"{configuration.repository_owner}/{configuration.repository_name}.git"
+def handle_events_of_kind(events, db, issue):
+    """
+    Handle pending events of one kind with a single ReleaseBot
+    :param events: list of json data from webhooks, all issues or all PRs
+    :param db: Redis instance
+    :param issue: if true the events are opened issues otherwise merged PRs
+    :return:
+    """
+    # the bot acts on behalf of the author of the latest event
+    release_bot, logger = set_configuration(events[-1], db=db, issue=issue)
+    kind, key = ("issue", "issue") if issue else ("pr", "pull_request")
+    numbers = sorted(
+        {
+            event[key]["number"]
+            for event in events
+            if not release_bot.state.is_processed(
+                release_bot.repository, kind, event[key]["number"]
+            )
+        }
     )
+    if not numbers:
+        logger.info(f"All {kind} events have already been processed")
+        return
 
-    return ReleaseBot(configuration), configuration.logger
+    try:
+        release_bot.git.pull_branch(release_bot.project.default_branch)
+        try:
+            release_bot.load_release_conf()
+        except ReleaseException as exc:
+            logger.error(exc)
+            return
+        if issue:
+            handle_issue(release_bot)
+        else:
+            handle_pr(release_bot, numbers)
+    finally:
+        release_bot.cleanup()
 
 
-def handle_issue(webhook_payload, db):
+def handle_issue(release_bot):
     """
-    Handler for newly opened issues
-    :param webhook_payload: json data from webhook
-    :param db: Redis instance
+    Handler for newly opened issues, all open release issues are looked up
+    :param release_bot: ReleaseBot instance with loaded release configuration
     :return:
     """
-    release_bot, logger = set_configuration(webhook_payload, db=db, issue=True)
-
+    logger = release_bot.logger
     logger.info("Resolving opened issue")
-    release_bot.git.pull_branch(release_bot.project.default_branch)
     try:
-        release_bot.load_release_conf()
         if (
             release_bot.new_release.trigger_on_issue
             and release_bot.find_open_release_issues()
@@ -123,25 +295,30 @@ def handle_issue(webhook_payload, db):
         logger.error(exc)
 
 
-def handle_pr(webhook_payload, db):
+def handle_pr(release_bot, pr_numbers):
     """
-    Handler for merged PR
-    :param webhook_payload: json data from webhook
-    :param db: Redis instance
+    Handler for merged PRs, the newest release PR is released
+    :param release_bot: ReleaseBot instance with loaded release configuration
+    :param pr_numbers: numbers of the merged PRs not processed yet
     :return:
     """
-    release_bot, logger = set_configuration(webhook_payload, db=db, issue=False)
-
+    logger = release_bot.logger
     logger.info("Resolving opened PR")
-    release_bot.git.pull_branch(release_bot.project.default_branch)
     try:
-        release_bot.load_release_conf()
         if release_bot.find_newest_release_pull_request():
             release_bot.make_new_github_release()
             # Try to do PyPi release regardless whether we just did github release
             # for case that in previous iteration (of the 'while True' loop)
             # we succeeded with github release, but failed with PyPi release
             release_bot.make_new_pypi_release()
+            if release_bot.is_release_complete():
+                for pr_number in pr_numbers:
+                    release_bot.state.mark_processed(
+                        release_bot.repository,
+                        "pr",
+                        pr_number,
+                        release_bot.new_release.version,
+                    )
     except ReleaseException as exc:
         logger.error(exc)
 
@@ -0,0 +1,511 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module provides lookup of changelog sections by version
+and generation of changelogs from git history
+"""
+import codecs
+import hashlib
+import json
+import logging
+import os
+import re
+import subprocess
+import tempfile
+import threading
+from collections import OrderedDict
+
+import pystache
+
+from release_bot.init_repo import TEMPLATE_STRING
+
+logger = logging.getLogger("release-bot")
+
+# "# 1.2.3" or "# v1.2.3" at the start of the file or of a line,
+# other headings are a part of the section
+HEADING = re.compile(rb"(?:\A|\n)# (v?\d[\w.+!-]*)(?=\s|\Z)")
+
+
+class ChangelogIndex:
+    """
+    Byte offsets of sections of CHANGELOG.md.
+
+    The content is scanned for "# <version>" headings once, a section
+    is decoded only when it's asked for. A section starts with its heading
+    and ends before the newline preceding the next version heading, the same
+    way utils.parse_changelog cuts the first section. Headings which don't
+    start with a version are a part of the section.
+    """
+
+    def __init__(self, content: bytes):
+        """
+        :param content: content of CHANGELOG.md
+        """
+        self._content = content
+        self.sections = OrderedDict()  # version -> (start, end)
+        starts = []
+        for match in HEADING.finditer(content):
+            start = match.start(1) - 2  # "# " before the version
+            if starts:
+                previous_version, previous_start = starts[-1]
+                self.sections.setdefault(
+                    previous_version, (previous_start, match.start())
+                )
+            starts.append((match.group(1).decode("utf-8", "replace"), start))
+        if starts:
+            last_version, last_start = starts[-1]
+            self.sections.setdefault(last_version, (last_start, len(content)))
+
+    @property
+    def versions(self):
+        """
+        :return: list of versions in the order they appear in the changelog
+        """
+        return list(self.sections)
+
+    def section(self, version):
+        """
+        Get changelog of the version
+        :param version: str, exact version
+        :return: section including its heading or None if there's none
+        """
+        offsets = self.sections.get(version)
+        if offsets is None:
+            return None
+        start, end = offsets
+        return self._content[start:end].decode("utf-8", "replace")
+
+
+class ChangelogIndexCache:
+    """
+    Thread-safe LRU cache of changelog indexes keyed by git blob SHA,
+    an unchanged CHANGELOG.md is never scanned again
+    """
+
+    def __init__(self, size=32):
+        self.size = size
+        self._indexes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, git, ref, file_path="CHANGELOG.md"):
+        """
+        Get index of the changelog as it is at ref
+        :param git: instance of Git
+        :param ref: branch, tag or commit
+        :param file_path: path to the changelog in the repository
+        :return: ChangelogIndex or None if the file doesn't exist at ref
+        """
+        sha = git.get_blob_sha(ref, file_path)
+        if sha is None:
+            return None
+        with self._lock:
+            if sha in self._indexes:
+                self._indexes.move_to_end(sha)
+                return self._indexes[sha]
+        content = git.read_blob(sha)
+        if content is None:
+            return None
+        logger.debug(f"Indexing {file_path} at {ref} ({sha})")
+        index = ChangelogIndex(content)
+        with self._lock:
+            self._indexes[sha] = index
+            while len(self._indexes) > self.size:
+                self._indexes.popitem(last=False)
+        return index
+
+
+changelog_indexes = ChangelogIndexCache()
+
+
+# rules of the default gitchangelog configuration (gitchangelog.rc.reference),
+# which is also the sample .gitchangelog.rc of release-bot
+IGNORE_REGEXPS = (
+    r"@minor",
+    r"!minor",
+    r"@cosmetic",
+    r"!cosmetic",
+    r"@refactor",
+    r"!refactor",
+    r"@wip",
+    r"!wip",
+    r"^([cC]hg|[fF]ix|[nN]ew)\s*:\s*[p|P]kg:",
+    r"^([cC]hg|[fF]ix|[nN]ew)\s*:\s*[d|D]ev:",
+    r"^(.{3,3}\s*:)?\s*[fF]irst commit.?\s*$",
+    r"^$",
+)
+SECTION_REGEXPS = (
+    ("New", r"^[nN]ew\s*:\s*((dev|use?r|pkg|test|doc)\s*:\s*)?([^\n]*)$"),
+    ("Changes", r"^[cC]hg\s*:\s*((dev|use?r|pkg|test|doc)\s*:\s*)?([^\n]*)$"),
+    ("Fix", r"^[fF]ix\s*:\s*((dev|use?r|pkg|test|doc)\s*:\s*)?([^\n]*)$"),
+    ("Other", None),
+)
+SUBJECT_PREFIX = re.compile(
+    r"^([cC]hg|[fF]ix|[nN]ew)\s*:\s*((dev|use?r|pkg|test|doc)\s*:\s*)?"
+    r"([^\n@]*)(@[a-z]+\s+)*$"
+)
+BODY_TRAILERS = re.compile(r"((^|\n)[A-Z]\w+(-\w+)*: .*(\n\s+.*)*)+$")
+UNRELEASED_VERSION_LABEL = "(unreleased)"
+
+# one pass over a subject instead of one search per rule
+IGNORED = re.compile("|".join(f"(?:{regexp})" for regexp in IGNORE_REGEXPS))
+SECTIONS = [
+    (label, re.compile(regexp) if regexp else None) for label, regexp in SECTION_REGEXPS
+]
+
+# statements of .gitchangelog.rc the engine implements, without whitespace,
+# so lines may be wrapped anywhere
+DEFAULT_RC = re.sub(
+    r"\s",
+    "",
+    r"""
+ignore_regexps = [
+    r'@minor', r'!minor', r'@cosmetic', r'!cosmetic',
+    r'@refactor', r'!refactor', r'@wip', r'!wip',
+    r'^([cC]hg|[fF]ix|[nN]ew)\s*:\s*[p|P]kg:',
+    r'^([cC]hg|[fF]ix|[nN]ew)\s*:\s*[d|D]ev:',
+    r'^(.{3,3}\s*:)?\s*[fF]irst commit.?\s*$',
+    r'^$',
+]
+section_regexps = [
+    ('New', [r'^[nN]ew\s*:\s*((dev|use?r|pkg|test|doc)\s*:\s*)?([^\n]*)$',]),
+    ('Changes', [r'^[cC]hg\s*:\s*((dev|use?r|pkg|test|doc)\s*:\s*)?([^\n]*)$',]),
+    ('Fix', [r'^[fF]ix\s*:\s*((dev|use?r|pkg|test|doc)\s*:\s*)?([^\n]*)$',]),
+    ('Other', None),
+]
+body_process = ReSub(r'((^|\n)[A-Z]\w+(-\w+)*: .*(\n\s+.*)*)+$', r'') | strip
+subject_process = (strip |
+    ReSub(r'^([cC]hg|[fF]ix|[nN]ew)\s*:\s*((dev|use?r|pkg|test|doc)\s*:\s*)?
+          ([^\n@]*)(@[a-z]+\s+)*$', r'\4') |
+    SetIfEmpty("No commit message.") | ucfirst | final_dot)
+tag_filter_regexp = r'^[0-9]+\.[0-9]+(\.[0-9]+)?$'
+unreleased_version_label = "(unreleased)"
+include_merge = True
+revs = []
+""",
+)
+OUTPUT_ENGINE = re.compile(r"output_engine=mustache\([\"']([^\"']+)[\"']\)")
+
+
+def get_engine_template(repo_path):
+    """
+    Find out whether the gitchangelog configuration of the repository
+    can be handled by ChangelogEngine: only the default .gitchangelog.rc
+    of release-bot can, without any rc gitchangelog writes reST
+
+    :param repo_path: path to the repository
+    :return: mustache template or None if gitchangelog has to be run
+    """
+    rc_path = os.path.join(repo_path, ".gitchangelog.rc")
+    if not os.path.isfile(rc_path):
+        return None
+    with open(rc_path) as rc_file:
+        rc = re.sub(r"#.*", "", rc_file.read())
+    rc = re.sub(r"\s", "", rc)
+    match = OUTPUT_ENGINE.search(rc)
+    if not match:
+        return None
+    template_name = match.group(1)
+    start, end = match.span()
+    rc = rc[:start] + rc[end:]
+    if rc not in ("", DEFAULT_RC):
+        return None
+    template_path = os.path.join(repo_path, template_name)
+    if os.path.isfile(template_path):
+        with open(template_path) as template_file:
+            return template_file.read()
+    return TEMPLATE_STRING
+
+
+def ucfirst(text):
+    return text[:1].upper() + text[1:]
+
+
+def final_dot(text):
+    return text + "." if text and text[-1].isalnum() else text
+
+
+def indent(text, chars="  "):
+    return "\n".join((chars + line).rstrip() for line in text.split("\n"))
+
+
+class ChangelogEngine:
+    """
+    Generates changelog the way gitchangelog does with its default rules,
+    without running it: commits are read from a single git log stream,
+    sorted into sections and rendered with a mustache template.
+    """
+
+    # fields of a commit in the git log stream
+    LOG_FORMAT = "%an%x00%s%x00%b"
+    FIELDS = 3
+
+    def __init__(self, repo_path, template=TEMPLATE_STRING, chunk_size=64 * 1024):
+        """
+        :param repo_path: path to the repository
+        :param template: mustache template, e.g. content of markdown.tpl
+        :param chunk_size: size of chunks the git log output is read in
+        """
+        self.repo_path = repo_path
+        self.template = template
+        self.chunk_size = chunk_size
+
+    def iter_commits(self, *revisions):
+        """
+        Read commits from git log without buffering its whole output
+        :param revisions: revisions passed to git log
+        :return: generator of tuples (author, subject, body)
+        """
+        process = subprocess.Popen(
+            ["git", "log", "-z", "--topo-order", f"--format={self.LOG_FORMAT}"]
+            + list(revisions)
+            + ["--"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=self.repo_path,
+        )
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        fields = []
+        rest = ""
+        try:
+            while True:
+                chunk = process.stdout.read(self.chunk_size)
+                rest += decoder.decode(chunk, final=not chunk)
+                *values, rest = rest.split("\0")
+                for value in values:
+                    fields.append(value)
+                    if len(fields) == self.FIELDS:
+                        yield tuple(fields)
+                        fields = []
+                if not chunk:
+                    break
+            if rest or fields:
+                fields.append(rest)
+                if len(fields) == self.FIELDS:
+                    yield tuple(fields)
+        finally:
+            process.stdout.close()
+            process.wait()
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, process.args)
+
+    @staticmethod
+    def get_section(subject):
+        for label, regexp in SECTIONS:
+            if regexp is None or regexp.search(subject):
+                return label
+
+    @staticmethod
+    def process_subject(subject):
+        subject = SUBJECT_PREFIX.sub(r"\4", subject.strip())
+        return final_dot(ucfirst(subject or "No commit message."))
+
+    @staticmethod
+    def process_body(body):
+        return BODY_TRAILERS.sub("", body).strip()
+
+    def get_commits(self, *revisions):
+        """
+        :param revisions: revisions passed to git log
+        :return: dict, section label -> list of commits (author, subject, body),
+                 newest first
+        """
+        sections = OrderedDict((label, []) for label, _ in SECTION_REGEXPS)
+        for author, subject, body in self.iter_commits(*revisions):
+            if IGNORED.search(subject):
+                continue
+            sections[self.get_section(subject)].append(
+                {
+                    "author": author,
+                    "subject": self.process_subject(subject),
+                    "body": self.process_body(body),
+                }
+            )
+        return sections
+
+    def render_commits(self, commits):
+        """
+        :param commits: dict returned by get_commits
+        :return: changelog or empty string if there are no commits
+        """
+        sections = [
+            {
+                "label": label,
+                "label_chars": list(label),
+                "commits": [
+                    dict(
+                        commit,
+                        authors=[commit["author"]],
+                        author_names_joined=commit["author"],
+                        body_indented=indent(commit["body"]),
+                    )
+                    for commit in section_commits
+                ],
+            }
+            for label, section_commits in commits.items()
+            if section_commits
+        ]
+        if not sections:
+            return ""
+        for section in sections:
+            section["display_label"] = not (
+                section["label"] == "Other" and len(sections) == 1
+            )
+        version = {
+            "tag": None,
+            "label": UNRELEASED_VERSION_LABEL,
+            "label_chars": list(UNRELEASED_VERSION_LABEL),
+            "sections": sections,
+        }
+        data = {
+            "title": None,
+            "general_title": False,
+            "title_chars": [],
+            "versions": [version],
+        }
+        return pystache.render(self.template, data)
+
+    def render(self, since, until="HEAD"):
+        """
+        Render changelog of commits which are in until and not in since,
+        the same as gitchangelog ^since until
+        :param since: previous version
+        :param until: the last commit of the changelog
+        :return: changelog or empty string if there are no commits
+        """
+        return self.render_commits(self.get_commits(f"^{since}", until))
+
+
+class ChangelogCache:
+    """
+    On-disk cache of generated changelogs.
+
+    An entry is a JSON file <cache_dir>/<range key>/<head SHA>.json,
+    the range key is a hash of the repository, the base commit, the generator
+    and its template. Entries with the same range key and an older head let
+    a changelog be extended by the commits made since. Entries are written
+    atomically, so workers racing on the same repository can share the cache.
+    Least recently used entries are removed when the cache grows over its quota.
+    """
+
+    def __init__(self, cache_dir, quota_mb=None):
+        """
+        :param cache_dir: directory with the cached changelogs
+        :param quota_mb: maximal size of the cache in MB, unlimited if None
+        """
+        self.cache_dir = str(cache_dir)
+        self.quota = quota_mb * 1024 * 1024 if quota_mb else None
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def range_key(repository, base, generator, template=""):
+        """
+        :param repository: repository url without credentials
+        :param base: SHA of the commit the changelog starts after
+        :param generator: name of the changelog generator
+        :param template: template or configuration of the generator
+        :return: str
+        """
+        template_hash = hashlib.sha256(template.encode()).hexdigest()
+        key = "\0".join((repository, base, generator, template_hash))
+        return hashlib.sha256(key.encode()).hexdigest()[:32]
+
+    def _path(self, key, head):
+        return os.path.join(self.cache_dir, key, f"{head}.json")
+
+    def get(self, key, head):
+        """
+        :param key: range key
+        :param head: SHA of the last commit of the changelog
+        :return: cached data or None
+        """
+        path = self._path(key, head)
+        try:
+            with open(path) as entry:
+                data = json.load(entry)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return data
+
+    def heads(self, key):
+        """
+        :param key: range key
+        :return: list of cached heads, the most recently used first
+        """
+        directory = os.path.join(self.cache_dir, key)
+        entries = {}
+        try:
+            for name in os.listdir(directory):
+                if name.endswith(".json"):
+                    try:
+                        entries[name[: -len(".json")]] = os.path.getmtime(
+                            os.path.join(directory, name)
+                        )
+                    except OSError:
+                        pass  # evicted meanwhile
+        except OSError:
+            return []
+        return sorted(entries, key=entries.get, reverse=True)
+
+    def put(self, key, head, data):
+        """
+        :param key: range key
+        :param head: SHA of the last commit of the changelog
+        :param data: JSON serializable data
+        """
+        directory = os.path.join(self.cache_dir, key)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as entry:
+                json.dump(data, entry)
+            os.replace(temp_path, self._path(key, head))
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache fits into its quota
+        """
+        if self.quota is None:
+            return
+        entries = {}
+        total = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                total += stat.st_size
+                if name.endswith(".json"):
+                    entries[path] = (stat.st_mtime, stat.st_size)
+        for path in sorted(entries, key=lambda path: entries[path][0]):
+            if total <= self.quota:
+                break
+            logger.debug(f"Evicting cached changelog {path}")
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= entries[path][1]
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError:
+                pass  # not empty
@@ -15,8 +15,10 @@
 
 
 import configparser
+import copy
 import logging
 import sys
+import threading
 from pathlib import Path
 from typing import Optional, List, Dict
 
@@ -25,7 +27,7 @@ from ogr import GithubService, PagureService, get_project
 from ogr.abstract import GitProject
 
 from release_bot.version import __version__
-from release_bot.github import GitHubApp
+from release_bot.github import get_github_app
 
 
 class Configuration:
@@ -59,6 +61,32 @@ class Configuration:
         self.webhook_handler = False
         self.gitchangelog = False
         self.project: Optional[GitProject] = None
+        # daemon mode: watch several repositories ("owner/name") from one process
+        self.daemon = False
+        self.repositories: List[str] = []
+        self.concurrency = 4
+        # path to SQLite database with the bot's state, in-memory if empty
+        self.state_db = ""
+        # directory with bare mirrors of repositories reused by all clones
+        self.mirror_cache_dir = ""
+        # size limit of the mirror cache in MB
+        self.mirror_cache_quota = None
+        # directory with generated changelogs reused by retries and other workers
+        self.changelog_cache_dir = ""
+        # size limit of the changelog cache in MB
+        self.changelog_cache_quota = None
+        # where distributions are uploaded, repository from ~/.pypirc if empty
+        self.pypi_repository_url = ""
+        # PEP 503 simple index used to find out which files are already uploaded,
+        # if empty known only for uploads to PyPI and TestPyPI
+        self.pypi_index_url = ""
+        # build distributions when a release PR is made, the release reuses them
+        self.prebuild = False
+        # directory with built distributions reused for the same git tree,
+        # release-bot/builds in the user cache directory if empty
+        self.build_cache_dir = ""
+        # how to clone: filter, depth, sparse (list of patterns), skip_lfs
+        self.clone_strategy: Dict = {}
 
     def set_logging(
         self,
@@ -96,6 +124,14 @@ class Configuration:
 
     def load_configuration(self):
         """Load bot configuration from .yaml file"""
+        self.load_configuration_file()
+        self.project = self.get_project()
+        self.logger.debug(
+            f"Loaded configuration for {self.repository_owner}/{self.repository_name}"
+        )
+
+    def load_configuration_file(self):
+        """Set attributes from .yaml file, without creating ogr project"""
         if not self.configuration:
             # configuration not supplied, look for conf.yaml in cwd
             path = Path.cwd() / "conf.yaml"
@@ -116,15 +152,43 @@ class Configuration:
                 sys.exit(1)
         # if user hasn't specified clone_url, use default
         if "clone_url" not in file:
-            self.clone_url = (
-                f"https://github.com/{self.repository_owner}"
-                f"/{self.repository_name}.git"
-            )
-        self.project = self.get_project()
-        self.logger.debug(
-            f"Loaded configuration for {self.repository_owner}/{self.repository_name}"
+            self.clone_url = self.get_clone_url()
+
+    def get_clone_url(self, token=None):
+        """
+        :param token: github app installation token to put into the url
+        :return: https url of the Github repository
+        """
+        credentials = f"x-access-token:{token}@" if token else ""
+        return (
+            f"https://{credentials}github.com/"
+            f"{self.repository_owner}/{self.repository_name}.git"
         )
 
+    def derive(self, **overrides):
+        """
+        Create a copy of this configuration, e.g. for another repository
+
+        :param overrides: attributes to change in the copy
+        :return: new Configuration instance with its own ogr project
+        """
+        conf = copy.copy(self)
+        # the copy must not share mutable values with this configuration
+        for key, value in list(vars(conf).items()):
+            if isinstance(value, (dict, list)):
+                setattr(conf, key, copy.deepcopy(value))
+        for key, value in overrides.items():
+            setattr(conf, key, value)
+        repository_changed = {"repository_owner", "repository_name"} & set(overrides)
+        if repository_changed and "clone_url" not in overrides:
+            conf.clone_url = conf.get_clone_url()
+        conf.project = conf.get_project()
+        if repository_changed and "clone_url" not in overrides:
+            if conf.github_app_installation_id:
+                # create url for github app to enable access over http
+                conf.clone_url = conf.get_clone_url(token=conf.github_token)
+        return conf
+
     def load_release_conf(self, conf):
         """
         Load items from release-conf.yaml
@@ -203,6 +267,28 @@ class Configuration:
 
         return None
 
+    def refresh_github_app_token(self):
+        """
+        Use the current installation token of the Github app as github_token,
+        tokens expire after an hour, so long-lived bots call this every cycle.
+        A clone_url with the previous token gets the new one.
+        :return: True if the token has changed
+        """
+        if not (self.github_app_id and self.github_app_installation_id):
+            return False
+        github_app = get_github_app(self.github_app_id, self.github_app_cert_path)
+        token = github_app.get_installation_access_token(
+            self.github_app_installation_id
+        )
+        if token == self.github_token:
+            return False
+        if self.github_token and self.clone_url == self.get_clone_url(
+            token=self.github_token
+        ):
+            self.clone_url = self.get_clone_url(token=token)
+        self.github_token = token
+        return True
+
     def get_project(self):
         """
         Create ogr project instance based on provided configuration.
@@ -213,12 +299,8 @@ class Configuration:
         if self.github_app_id:
             github_cert = Path(self.github_app_cert_path).read_text()
 
-            if self.github_app_installation_id:
-                # github token will be used as a credential over http (commit/push)
-                github_app = GitHubApp(self.github_app_id, self.github_app_cert_path)
-                self.github_token = github_app.get_installation_access_token(
-                    self.github_app_installation_id
-                )
+            # github token will be used as a credential over http (commit/push)
+            self.refresh_github_app_token()
 
             return get_project(
                 url=self.clone_url,
@@ -243,4 +325,30 @@ class Configuration:
         )
 
 
+_base_configurations = {}  # path -> (modification time, Configuration)
+_base_configurations_lock = threading.Lock()
+
+
+def get_base_configuration(path):
+    """
+    Get configuration loaded from the file, it is loaded again when the file
+    changes. The instance is shared by all threads and must not be modified,
+    derive() a configuration of a repository from it.
+
+    :param path: path to conf.yaml
+    :return: Configuration instance without ogr project
+    """
+    path = Path(path).resolve()
+    mtime = path.stat().st_mtime_ns
+    with _base_configurations_lock:
+        cached = _base_configurations.get(path)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        conf = Configuration()
+        conf.configuration = path
+        conf.load_configuration_file()
+        _base_configurations[path] = (mtime, conf)
+        return conf
+
+
 configuration = Configuration()
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module provides polling of many repositories from a single process
+"""
+import heapq
+import itertools
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from release_bot.exceptions import ReleaseException
+from release_bot.github import get_github_app
+from release_bot.releasebot import ReleaseBot
+
+
+class Daemon:
+    """
+    Runs reconcile cycles of many repositories on a bounded pool of workers.
+
+    Every repository keeps its own ReleaseBot (clone, snapshot, caches) between
+    cycles. A repository is scheduled again refresh_interval seconds after its
+    previous cycle finished and is never reconciled by two workers at once.
+    Repositories that are due at the same time run in first-come order.
+    """
+
+    def __init__(self, configuration):
+        """
+        :param configuration: instance of Configuration, shared by all repositories
+        """
+        self.conf = configuration
+        self.logger = configuration.logger
+        self.concurrency = max(int(configuration.concurrency or 1), 1)
+        self.bots = {}
+        self.queue = []  # heap of (due time, sequence number, repository)
+        self.sequence = itertools.count()
+
+    def get_repositories(self):
+        """
+        Repositories to watch: listed in configuration
+        or all repositories of the Github app installation
+        :return: list of str ("owner/name")
+        """
+        if self.conf.repositories:
+            return list(self.conf.repositories)
+        if self.conf.github_app_id and self.conf.github_app_installation_id:
+            github_app = get_github_app(
+                self.conf.github_app_id, self.conf.github_app_cert_path
+            )
+            return github_app.get_installation_repositories(
+                self.conf.github_app_installation_id
+            )
+        raise ReleaseException(
+            "Daemon mode needs 'repositories' or a Github app installation configured"
+        )
+
+    def schedule(self, repository, due):
+        heapq.heappush(self.queue, (due, next(self.sequence), repository))
+
+    def get_bot(self, repository):
+        """
+        Get ReleaseBot of the repository, create it on first use
+        :param repository: str, "owner/name"
+        :return: ReleaseBot instance
+        """
+        if repository not in self.bots:
+            owner, name = repository.split("/", 1)
+            conf = self.conf.derive(repository_owner=owner, repository_name=name)
+            self.bots[repository] = ReleaseBot(conf)
+        return self.bots[repository]
+
+    def reconcile(self, repository):
+        """
+        Unit of work executed by a worker: one reconcile cycle of one repository
+        :param repository: str, "owner/name"
+        """
+        try:
+            self.get_bot(repository).reconcile()
+        except Exception as exc:
+            # one broken repository must not stop the others
+            self.logger.error(f"Reconciling {repository} failed: {exc!r}")
+
+    def run(self):
+        self.logger.info(f"release-bot v{self.conf.version} reporting for duty!")
+        if self.conf.dry_run:
+            self.logger.info("Running in dry-run mode.")
+        repositories = self.get_repositories()
+        self.logger.info(
+            f"Watching {len(repositories)} repositories "
+            f"with {self.concurrency} workers"
+        )
+        now = time.monotonic()
+        for repository in repositories:
+            self.schedule(repository, now)
+
+        running = {}
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                while self.queue or running:
+                    now = time.monotonic()
+                    while (
+                        self.queue
+                        and self.queue[0][0] <= now
+                        and len(running) < self.concurrency
+                    ):
+                        _, _, repository = heapq.heappop(self.queue)
+                        running[
+                            executor.submit(self.reconcile, repository)
+                        ] = repository
+
+                    timeout = None
+                    if self.queue and len(running) < self.concurrency:
+                        timeout = max(self.queue[0][0] - now, 0)
+                    if not running:
+                        time.sleep(timeout)
+                        continue
+
+                    done, _ = wait(
+                        running, timeout=timeout, return_when=FIRST_COMPLETED
+                    )
+                    for future in done:
+                        repository = running.pop(future)
+                        if self.conf.refresh_interval:
+                            self.schedule(
+                                repository,
+                                time.monotonic() + self.conf.refresh_interval,
+                            )
+        finally:
+            for bot in self.bots.values():
+                bot.cleanup()
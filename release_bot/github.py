@@ -13,33 +13,49 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 import logging
-import os
 import re
+import threading
 import time
+from collections import namedtuple
+from datetime import datetime, timezone
 
 import jwt
 import requests
 from ogr.abstract import PRStatus, GitProject
-from semantic_version import Version
 
+from release_bot.changelog import changelog_indexes
 from release_bot.exceptions import ReleaseException, GitException
+from release_bot.http_cache import ConditionalSession
+from release_bot.metrics import metrics
+from release_bot.snapshot import ForgeSnapshot
 from release_bot.utils import (
     insert_in_changelog,
-    parse_changelog,
     look_for_version_files,
+    update_version_files,
     GitService,
     which_service,
 )
 
 logger = logging.getLogger("release-bot")
 
+# connect and read timeouts of requests to Github API
+REQUEST_TIMEOUT = (5, 30)
+
+MergedPR = namedtuple("MergedPR", ["id", "title", "author", "merged_at"])
+
 
 # github app auth code "stolen" from https://github.com/swinton/github-app-demo.py
 class JWTAuth(requests.auth.AuthBase):
+    # a new JWT is signed this many seconds before the previous one expires
+    RENEW_MARGIN = 60
+
     def __init__(self, iss, key, expiration=10 * 60):
         self.iss = iss
         self.key = key
         self.expiration = expiration
+        self._token = None
+        self._token_expires_at = 0
+        self._lock = threading.Lock()
 
     def generate_token(self):
         # Generate the JWT
@@ -54,16 +70,43 @@ class JWTAuth(requests.auth.AuthBase):
 
         tok = jwt.encode(payload, self.key, algorithm="RS256")
 
-        return tok.decode("utf-8")
+        # PyJWT < 2 returns bytes
+        return tok.decode("utf-8") if isinstance(tok, bytes) else tok
+
+    def get_token(self):
+        """
+        :return: JWT signed by a previous call if it doesn't expire soon
+        """
+        with self._lock:
+            if time.time() >= self._token_expires_at - self.RENEW_MARGIN:
+                self._token_expires_at = time.time() + self.expiration
+                self._token = self.generate_token()
+            return self._token
 
     def __call__(self, r):
-        r.headers["Authorization"] = "bearer {}".format(self.generate_token())
+        r.headers["Authorization"] = "bearer {}".format(self.get_token())
+        return r
+
+
+class InstallationTokenAuth(requests.auth.AuthBase):
+    """
+    Authorization with the cached installation access token of a Github app
+    """
+
+    def __init__(self, github_app, installation_id):
+        self.github_app = github_app
+        self.installation_id = installation_id
+
+    def __call__(self, r):
+        token = self.github_app.get_installation_access_token(self.installation_id)
+        r.headers["Authorization"] = f"token {token}"
         return r
 
 
 class GitHubApp:
     def __init__(self, app_id, private_key_path):
-        self.session = requests.Session()
+        self.app_id = app_id
+        self.session = ConditionalSession()
         self.session.headers.update(
             dict(accept="application/vnd.github.machine-man-preview+json")
         )
@@ -76,7 +119,7 @@ class GitHubApp:
 
     def _request(self, method, path):
         response = self.session.request(
-            method, "https://{}/{}".format(self.domain, path)
+            method, "https://{}/{}".format(self.domain, path), timeout=REQUEST_TIMEOUT
         )
         return response.json()
 
@@ -98,10 +141,185 @@ class GitHubApp:
     def get_installations(self):
         return self._get("app/installations")
 
+    def create_installation_access_token(self, installation_id):
+        """
+        Ask Github for a new installation access token
+        :param installation_id: installation identifier
+        :return: dict with "token" and "expires_at"
+        """
+        return self._post("installations/{}/access_tokens".format(installation_id))
+
     def get_installation_access_token(self, installation_id):
-        return self._post("installations/{}/access_tokens".format(installation_id))[
-            "token"
-        ]
+        """
+        Installation access token, cached by the process until it expires
+        :param installation_id: installation identifier
+        :return: str
+        """
+        return github_app_tokens.get(self, installation_id)
+
+    def get_installation_repositories(self, installation_id):
+        """
+        List full names of all repositories accessible to the installation
+        :param installation_id: installation identifier
+        :return: list of str ("owner/name")
+        """
+        repositories = []
+        page = 1
+        while True:
+            try:
+                response = self.session.get(
+                    "https://{}/installation/repositories".format(self.domain),
+                    params={"per_page": 100, "page": page},
+                    # the installation token instead of the JWT of the app
+                    auth=InstallationTokenAuth(self, installation_id),
+                    timeout=REQUEST_TIMEOUT,
+                )
+            except requests.RequestException as exc:
+                raise ReleaseException(
+                    f"Can't list repositories of installation {installation_id}: {exc}"
+                )
+            if response.status_code != 200:
+                raise ReleaseException(
+                    f"Can't list repositories of installation {installation_id}: "
+                    f"{response.status_code} {response.reason}"
+                )
+            response = response.json()
+            repositories += [repo["full_name"] for repo in response["repositories"]]
+            if (
+                not response["repositories"]
+                or len(repositories) >= response["total_count"]
+            ):
+                return repositories
+            page += 1
+
+
+class GitHubAppTokens:
+    """
+    Process-wide cache of Github apps and installation access tokens.
+
+    Apps are shared, so their JWT is signed once per its lifetime. A token
+    is reused until REFRESH_MARGIN seconds before its expires_at. At that
+    moment, tokens which have been used since they were obtained are
+    refreshed in the background, so tasks normally find a valid token
+    without asking Github.
+    """
+
+    REFRESH_MARGIN = 5 * 60
+    # lifetime assumed when Github doesn't send expires_at
+    DEFAULT_LIFETIME = 60 * 60
+
+    def __init__(self):
+        self._apps = {}  # (app id, private key path) -> GitHubApp
+        self._tokens = {}  # (app id, installation id) -> dict token, expires_at, used
+        self._locks = {}  # key -> lock held while the token is obtained
+        self._timers = {}  # key -> timer of the background refresh
+        self._lock = threading.Lock()
+
+    def get_app(self, app_id, private_key_path):
+        """
+        :return: GitHubApp shared by the process
+        """
+        key = (str(app_id), str(private_key_path))
+        with self._lock:
+            if key not in self._apps:
+                self._apps[key] = GitHubApp(app_id, private_key_path)
+            return self._apps[key]
+
+    def _cached(self, key):
+        with self._lock:
+            entry = self._tokens.get(key)
+            if entry and time.time() < entry["expires_at"] - self.REFRESH_MARGIN:
+                entry["used"] = True
+                return entry["token"]
+            return None
+
+    def get(self, github_app, installation_id):
+        """
+        :param github_app: GitHubApp instance
+        :param installation_id: installation identifier
+        :return: installation access token
+        """
+        key = (str(github_app.app_id), str(installation_id))
+        token = self._cached(key)
+        if token:
+            metrics.inc("github_app_token_hit")
+            return token
+        with self._lock:
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            # obtained by another thread meanwhile?
+            token = self._cached(key)
+            if not token:
+                token = self._obtain(github_app, installation_id, used=True)
+        return token
+
+    @classmethod
+    def _parse_expires_at(cls, value):
+        try:
+            expires_at = datetime.strptime(value, "%Y-%m-%dT%H:%M:%SZ")
+            return expires_at.replace(tzinfo=timezone.utc).timestamp()
+        except (TypeError, ValueError):
+            return time.time() + cls.DEFAULT_LIFETIME
+
+    def _obtain(self, github_app, installation_id, used):
+        key = (str(github_app.app_id), str(installation_id))
+        response = github_app.create_installation_access_token(installation_id)
+        if "token" not in response:
+            raise ReleaseException(
+                f"Can't obtain access token of installation {installation_id}: "
+                f"{response.get('message')}"
+            )
+        expires_at = self._parse_expires_at(response.get("expires_at"))
+        metrics.inc("github_app_token_obtained")
+        logger.debug(f"github app token of installation {installation_id} obtained")
+
+        timer = threading.Timer(
+            max(expires_at - self.REFRESH_MARGIN - time.time(), 0),
+            self._refresh,
+            args=(github_app, installation_id),
+        )
+        timer.daemon = True
+        with self._lock:
+            self._tokens[key] = dict(
+                token=response["token"], expires_at=expires_at, used=used
+            )
+            previous = self._timers.pop(key, None)
+            self._timers[key] = timer
+        if previous:
+            previous.cancel()
+        timer.start()
+        return response["token"]
+
+    def _refresh(self, github_app, installation_id):
+        key = (str(github_app.app_id), str(installation_id))
+        with self._lock:
+            entry = self._tokens.get(key)
+            if not entry or not entry["used"]:
+                # nobody needs the token, don't keep refreshing it
+                self._timers.pop(key, None)
+                return
+            lock = self._locks.setdefault(key, threading.Lock())
+        with lock:
+            try:
+                self._obtain(github_app, installation_id, used=False)
+            except Exception as exc:
+                # the next get() obtains the token itself
+                logger.warning(
+                    f"Couldn't refresh token of installation {installation_id}: {exc!r}"
+                )
+
+
+github_app_tokens = GitHubAppTokens()
+
+
+def get_github_app(app_id, private_key_path):
+    """
+    GitHubApp shared by the process, so that its JWT and tokens are reused
+    :param app_id: ID of the Github app
+    :param private_key_path: path to the private key of the app
+    :return: GitHubApp instance
+    """
+    return github_app_tokens.get_app(app_id, private_key_path)
 
 
 class Github:
@@ -113,30 +331,52 @@ class Github:
         self.conf = configuration
         self.logger = configuration.logger
         self.project: GitProject = configuration.project
-        self.session = requests.Session()
-        self.session.headers.update(
-            {"Authorization": f"token {configuration.github_token}"}
-        )
+        self.session = ConditionalSession()
+        if configuration.github_token:
+            self.set_token(configuration.github_token)
         self.github_app_session = None
         if (
             self.conf.github_app_installation_id
             and self.conf.github_app_id
             and self.conf.github_app_cert_path
         ):
-            self.github_app_session = requests.Session()
-            self.github_app = GitHubApp(
+            self.github_app_session = ConditionalSession()
+            self.github_app = get_github_app(
                 self.conf.github_app_id, self.conf.github_app_cert_path
             )
             self.update_github_app_token()
+        # Github Enterprise serves the API under /api/v3 of its own host
+        hostname = getattr(getattr(self.project, "service", None), "hostname", None)
+        self.domain = (
+            f"{hostname}/api/v3"
+            if hostname and hostname != "github.com"
+            else "api.github.com"
+        )
         self.comment = []
         self.git = git
+        self.snapshot = ForgeSnapshot(self.project)
+
+    def refresh_snapshot(self):
+        """
+        Start a new reconcile cycle with a fresh view of the project
+        """
+        self.snapshot = ForgeSnapshot(self.project)
+
+    def set_token(self, token):
+        """
+        Authorize requests of session with the token
+        :param token: Github token
+        """
+        self.session.headers.update({"Authorization": f"token {token}"})
 
     def update_github_app_token(self):
-        token = self.github_app.get_installation_access_token(
-            self.conf.github_app_installation_id
+        """
+        Authorize requests of github_app_session with the installation token,
+        the cached token is looked up for every request, so it never expires
+        """
+        self.github_app_session.auth = InstallationTokenAuth(
+            self.github_app, self.conf.github_app_installation_id
         )
-        self.logger.debug("github app token obtained")
-        self.github_app_session.headers.update({"Authorization": f"token {token}"})
 
     def latest_release(self):
         """
@@ -144,14 +384,12 @@ class Github:
 
         :return: Release number or 0.0.0
         """
-        releases = self.project.get_releases()
-        if not releases:
+        latest_release = self.snapshot.latest_release
+        if not latest_release:
             self.logger.debug("There is no github release")
             return "0.0.0"
 
-        release_versions = [release.title for release in releases]
-        release_versions.sort(key=Version)
-        return release_versions[-1]
+        return latest_release.title
 
     def walk_through_prs(self, pr_status):
         """
@@ -160,8 +398,44 @@ class Github:
         :param pr_status: ogr.abstract.PRStatus
         :return: list of merged prs
         """
+        if pr_status == PRStatus.merged:
+            return self.snapshot.merged_prs
+        if pr_status == PRStatus.open:
+            return self.snapshot.open_prs
         return self.project.get_pr_list(pr_status)
 
+    def get_merged_prs_since(self, watermark=None):
+        """
+        Get pull requests merged since the watermark, reading the PR list
+        (most recently updated first) only until the watermark is passed.
+        PRs updated in the same second as the watermark are read again,
+        so the caller may get an already processed PR once more.
+
+        :param watermark: datetime, update time of the newest PR already processed
+        :return: tuple (list of MergedPR, new watermark)
+        """
+        merged_prs = []
+        seen = set()
+        new_watermark = watermark
+        pulls = self.project.github_repo.get_pulls(
+            state="closed", sort="updated", direction="desc"
+        )
+        for pull in pulls:
+            if watermark and pull.updated_at < watermark:
+                break
+            # a PR updated while paginating shows up on a later page again
+            if pull.number in seen:
+                continue
+            seen.add(pull.number)
+            if not new_watermark or pull.updated_at > new_watermark:
+                new_watermark = pull.updated_at
+            if pull.merged_at:
+                merged_prs.append(
+                    MergedPR(pull.number, pull.title, pull.user.login, pull.merged_at)
+                )
+        self.logger.debug(f"{len(merged_prs)} PRs merged since {watermark}")
+        return merged_prs, new_watermark
+
     def make_new_release(self, new_release):
         """
         Makes new release to Github.
@@ -178,6 +452,8 @@ class Github:
             )
         except Exception:
             raise ReleaseException("Failed to create new release on github!")
+        finally:
+            self.snapshot.invalidate("releases")
 
         return True, new_release
 
@@ -188,24 +464,22 @@ class Github:
         :param new_version: version number
         :return:
         """
-        self.git.fetch_tags()
-        self.git.checkout(f"{new_version}-release")
-        self.git.pull_branch(f"{new_version}-release")
-        p = os.path.join(self.git.repo_path, "CHANGELOG.md")
-        try:
-            with open(p, "r") as fd:
-                changelog_content = fd.read()
-        except FileNotFoundError:
+        branch = f"{new_version}-release"
+        ref = f"origin/{branch}"
+        if not self.git.fetch_branch(branch):
+            # release branch may be deleted after merging the release PR
+            self.git.fetch_branch(self.project.default_branch)
+            ref = f"origin/{self.project.default_branch}"
+        index = changelog_indexes.get(self.git, ref)
+        if index is None:
             logger.info("CHANGELOG.md not found")
             return ""
-        finally:
-            self.git.checkout(self.project.default_branch)
 
-        changelog = parse_changelog(new_version, changelog_content)
-        latest_release = self.project.get_latest_release()
+        changelog = index.section(new_version) or "No changelog provided"
+        latest_release = self.snapshot.latest_release
 
         # check if the changelog needs updating
-        if latest_release.body == changelog:
+        if latest_release and latest_release.body == changelog:
             return ""
 
         return changelog
@@ -216,7 +490,7 @@ class Github:
         :param branch: name of the branch
         :return: True if exists, False if not
         """
-        return branch in self.project.get_branches()
+        return branch in self.snapshot.branches
 
     def make_pr(
         self, branch, version, log, changed_version_files, base: str = None, labels=None
@@ -262,6 +536,7 @@ class Github:
                 source_branch=branch,
             )
 
+            self.snapshot.invalidate("open_prs")
             self.logger.info(f"Created PR: {new_pr}")
             if labels and which_service(self.project) == GitService.Github:
                 # ogr-lib implements labeling only for Github labels
@@ -310,7 +585,7 @@ class Github:
                 new_pr.previous_version, gitchangelog
             )
             repo.checkout_new_branch(branch)
-            changed = look_for_version_files(repo.repo_path, new_pr.version)
+            changed = self.update_version_files(repo, new_pr)
             if insert_in_changelog(
                 f"{repo.repo_path}/CHANGELOG.md", new_pr.version, changelog
             ):
@@ -319,6 +594,7 @@ class Github:
                 repo.add(changed)
             repo.commit(f"{version} release", allow_empty=True)
             repo.push(branch)
+            self.snapshot.invalidate("branches")
             if not self.pr_exists(f"{version} release"):
                 new_pr.pr_url = self.make_pr(
                     branch=branch,
@@ -334,6 +610,37 @@ class Github:
             repo.checkout(self.project.default_branch)
         return False
 
+    def update_version_files(self, repo, new_pr):
+        """
+        Update version in files listed in release-conf.yaml; without such list
+        try files changed in the previous release and search the whole
+        repository only if none of them contains the version any more
+        :param repo: instance of Git
+        :param new_pr: object of class new_pr with info about the new release
+        :return: list of changed files
+        """
+        if new_pr.version_files:
+            changed = update_version_files(
+                repo.repo_path, new_pr.version, new_pr.version_files
+            )
+            if not changed:
+                self.logger.error("No version updated in files from version_files")
+        else:
+            changed = []
+            if new_pr.cached_version_files:
+                changed = update_version_files(
+                    repo.repo_path, new_pr.version, new_pr.cached_version_files
+                )
+            if not changed:
+                changed = look_for_version_files(
+                    repo.repo_path,
+                    new_pr.version,
+                    include=new_pr.version_files_include,
+                    exclude=new_pr.version_files_exclude,
+                )
+        new_pr.changed_version_files = changed
+        return changed
+
     def pr_exists(self, name):
         """
         Makes a call to github api to check if PR already exists
@@ -375,6 +682,8 @@ class Github:
         :return: file content or None in case of error
         """
         self.logger.debug(f"Fetching {name}")
+        if which_service(self.project) == GitService.Github:
+            return self.get_github_file(name, ref)
         try:
             file = self.project.get_file_content(path=name, ref=ref)
         except FileNotFoundError:
@@ -382,3 +691,29 @@ class Github:
             return None
 
         return file
+
+    def get_github_file(self, name: str, ref: str = None):
+        """
+        Fetches a specific file via Github contents API using conditional requests,
+        so an unchanged file costs neither a download nor a rate limit hit
+        @:param: str, name of the file
+        :return: file content or None in case of error
+        """
+        session = self.github_app_session or self.session
+        response = session.get(
+            f"https://{self.domain}/repos/{self.project.namespace}/"
+            f"{self.project.repo}/contents/{name}",
+            params={"ref": ref} if ref else None,
+            headers={"Accept": "application/vnd.github.v3.raw"},
+            timeout=REQUEST_TIMEOUT,
+        )
+        if response.status_code == 404:
+            # optional files, e.g. setup.cfg, are often missing
+            self.logger.debug(f"{name} not found")
+            return None
+        if response.status_code != 200:
+            self.logger.error(f"Failed to fetch {name}: {response.status_code}")
+            return None
+        if response.from_cache:
+            self.logger.debug(f"{name} has not changed")
+        return response.text
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module provides conditional (ETag/Last-Modified) HTTP requests
+"""
+import logging
+import threading
+
+import requests
+
+logger = logging.getLogger("release-bot")
+
+
+class ConditionalSession(requests.Session):
+    """
+    requests.Session which revalidates GET responses instead of re-downloading them.
+
+    ETag and Last-Modified of every successful GET are remembered per endpoint
+    and sent back as If-None-Match/If-Modified-Since. When the server answers
+    304 Not Modified, the previously received response is returned instead,
+    with its from_cache attribute set to True.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _cache_key(url, params, headers):
+        params = tuple(sorted((params or {}).items()))
+        accept = (headers or {}).get("Accept") or (headers or {}).get("accept")
+        return url, params, accept
+
+    def request(self, method, url, *args, **kwargs):
+        if method.upper() != "GET":
+            return super().request(method, url, *args, **kwargs)
+
+        key = self._cache_key(url, kwargs.get("params"), kwargs.get("headers"))
+        with self._lock:
+            cached = self._cache.get(key)
+        headers = dict(kwargs.pop("headers", None) or {})
+        if cached is not None:
+            if cached.headers.get("ETag"):
+                headers["If-None-Match"] = cached.headers["ETag"]
+            if cached.headers.get("Last-Modified"):
+                headers["If-Modified-Since"] = cached.headers["Last-Modified"]
+
+        response = super().request(method, url, *args, headers=headers, **kwargs)
+        if response.status_code == 304 and cached is not None:
+            logger.debug(f"{url} not modified, reusing cached response")
+            cached.from_cache = True
+            return cached
+
+        response.from_cache = False
+        if response.status_code == 200 and (
+            response.headers.get("ETag") or response.headers.get("Last-Modified")
+        ):
+            with self._lock:
+                self._cache[key] = response
+        return response
+
+    def invalidate(self):
+        """Forget all remembered responses"""
+        with self._lock:
+            self._cache.clear()
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module provides counters of what the bot did
+"""
+import threading
+from collections import Counter
+
+
+class Metrics:
+    """
+    Process-wide counters, safe to use from several threads
+    """
+
+    def __init__(self):
+        self._counters = Counter()
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def get(self, name):
+        with self._lock:
+            return self._counters[name]
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self._counters)
+
+
+metrics = Metrics()
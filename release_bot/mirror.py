@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module provides a cache of bare repository mirrors shared by all tasks
+"""
+import fcntl
+import hashlib
+import logging
+import os
+import re
+import shutil
+
+from release_bot.exceptions import GitException
+from release_bot.utils import run_command
+
+logger = logging.getLogger("release-bot")
+
+
+class MirrorCache:
+    """
+    Directory with one bare mirror of branches and tags per repository.
+
+    A mirror is updated with git fetch every time it is handed out, clones
+    then copy its objects (git clone --reference --dissociate) and only
+    download what the mirror doesn't have. Every mirror has a lock file:
+    it is held exclusively while the mirror is created, updated or evicted,
+    and shared while a clone copies objects from it. Clones don't depend
+    on the mirror afterwards, so the lock is held only for the clone.
+    Least recently used mirrors are evicted when the cache grows over
+    its quota.
+    """
+
+    def __init__(self, cache_dir, quota_mb=None):
+        """
+        :param cache_dir: directory with the mirrors
+        :param quota_mb: maximal size of all mirrors in MB, unlimited if None
+        """
+        self.cache_dir = str(cache_dir)
+        self.quota = quota_mb * 1024 * 1024 if quota_mb else None
+        self.locks_dir = os.path.join(self.cache_dir, "locks")
+        os.makedirs(self.locks_dir, exist_ok=True)
+
+    @staticmethod
+    def strip_credentials(url):
+        """Remove user:password@ from the url"""
+        return re.sub(r"^(\w+://)[^@/]+@", r"\1", url)
+
+    def _name(self, url):
+        return hashlib.sha256(self.strip_credentials(url).encode()).hexdigest()[:24]
+
+    def mirror_path(self, url):
+        return os.path.join(self.cache_dir, f"{self._name(url)}.git")
+
+    def _lock_path(self, url):
+        return os.path.join(self.locks_dir, f"{self._name(url)}.lock")
+
+    def acquire(self, url):
+        """
+        Create or update the mirror of the repository and keep it
+        from being evicted until release() is called, which should be
+        as soon as the clone using it is made
+
+        :param url: repository url, may contain credentials
+        :return: tuple (path to the mirror, lock to pass to release())
+        """
+        path = self.mirror_path(url)
+        lock = open(self._lock_path(url), "a")
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.isdir(path):
+                # url passed explicitly, credentials are not stored in the mirror;
+                # only branches and tags, not e.g. refs/pull/* of forges
+                run_command(
+                    path,
+                    f"git fetch --prune --quiet {url} "
+                    "+refs/heads/*:refs/heads/* +refs/tags/*:refs/tags/*",
+                    "Couldn't update repository mirror!",
+                    fail=True,
+                )
+            else:
+                success = run_command(
+                    self.cache_dir,
+                    f"git clone --bare --quiet {url} {path}",
+                    "Couldn't create repository mirror!",
+                    fail=False,
+                )
+                if not success:
+                    shutil.rmtree(path, ignore_errors=True)
+                    raise GitException(f"Can't mirror repository {url}")
+                run_command(
+                    path,
+                    f"git remote set-url origin {self.strip_credentials(url)}",
+                    "",
+                    fail=False,
+                )
+            os.utime(path)
+            fcntl.flock(lock, fcntl.LOCK_SH)
+        except Exception:
+            lock.close()
+            raise
+        self.evict(keep=path)
+        return path, lock
+
+    @staticmethod
+    def release(lock):
+        """
+        Allow eviction of the mirror again
+        :param lock: lock returned by acquire()
+        """
+        lock.close()
+
+    @staticmethod
+    def _size(path):
+        size = 0
+        for root, _, files in os.walk(path):
+            for file in files:
+                try:
+                    size += os.lstat(os.path.join(root, file)).st_size
+                except OSError:
+                    pass
+        return size
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used mirrors which are not in use
+        until the cache fits into its quota
+        :param keep: path to a mirror which must not be removed
+        """
+        if self.quota is None:
+            return
+        mirrors = {}
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(".git") and path != keep:
+                try:
+                    mirrors[path] = os.path.getmtime(path)
+                except OSError:
+                    pass  # evicted by someone else
+        total = self._size(self.cache_dir)
+        for mirror in sorted(mirrors, key=mirrors.get):
+            if total <= self.quota:
+                break
+            name = os.path.basename(mirror)[: -len(".git")]
+            with open(os.path.join(self.locks_dir, f"{name}.lock"), "a") as lock:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # in use
+                size = self._size(mirror)
+                logger.debug(f"Evicting mirror {mirror}")
+                shutil.rmtree(mirror, ignore_errors=True)
+                total -= size
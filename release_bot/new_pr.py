@@ -23,6 +23,13 @@ class NewPR:
         self.pr_url = None
         self.previous_version = None
         self.repo = None
+        self.version_files_include = None
+        self.version_files_exclude = None
+        # version files manifest from release-conf.yaml
+        self.version_files = None
+        # where the version was found in the previous release
+        self.cached_version_files = None
+        self.changed_version_files = None
 
     def update_new_pr_details(self, version, issue_id, issue_number, labels):
         self.version = version
@@ -27,9 +27,21 @@ class NewRelease:
         self.pr_number = None
         self.commitish = None
         self.version = None
+        self.version_files_include = None
+        self.version_files_exclude = None
+        self.version_files = None
 
     def update(
-        self, changelog, author_name, author_email, pypi, trigger_on_issue, labels
+        self,
+        changelog,
+        author_name,
+        author_email,
+        pypi,
+        trigger_on_issue,
+        labels,
+        version_files_include=None,
+        version_files_exclude=None,
+        version_files=None,
     ):
         # Update release-conf data
         self.changelog = changelog
@@ -38,6 +50,9 @@ class NewRelease:
         self.pypi = pypi
         self.trigger_on_issue = trigger_on_issue
         self.labels = labels
+        self.version_files_include = version_files_include
+        self.version_files_exclude = version_files_exclude
+        self.version_files = version_files
 
     def update_pr_details(
         self, version, author_name, author_email, pr_id, pr_number, commitish
@@ -12,18 +12,171 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+import re
 import shutil
+import tarfile
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
 import os
+from urllib.parse import unquote
+
 import requests
+from build import ProjectBuilder
+from build.env import DefaultIsolatedEnv
+from requests.adapters import HTTPAdapter
+from twine.commands.check import check as twine_check
+from twine.package import PackageFile
+from twine.settings import Settings
 
 from release_bot.exceptions import ReleaseException
-from release_bot.utils import run_command
+from release_bot.http_cache import ConditionalSession
+from release_bot.metrics import metrics
+from release_bot.state import get_state_store
+
+# number of files uploaded at once
+UPLOAD_WORKERS = 4
+# number of builds kept in the build cache
+BUILD_CACHE_ENTRIES = 20
+# build plugins which derive the version of a project from git
+VERSION_FROM_GIT = (
+    "setuptools_scm",
+    "setuptools-scm",
+    "use_scm_version",
+    "versioneer",
+    "hatch-vcs",
+    "pbr",
+    "dunamai",
+    "poetry-dynamic-versioning",
+)
+
+
+class PyPiClient:
+    """
+    Client of the PyPI JSON API shared by all bots of the process.
+
+    Requests go through one pooled ConditionalSession with timeouts, so
+    unchanged documents are revalidated with their ETag instead of being
+    downloaded again. Results are kept for a short time and concurrent
+    lookups of the same URL wait for the first one instead of repeating it.
+    """
+
+    _session = None
+    _results = {}  # url -> (expiration time, result)
+    _locks = {}  # url -> lock held while the url is being looked up
+    _lock = threading.Lock()
+
+    def __init__(self, base_url="https://pypi.org/pypi/", timeout=(5, 30), ttl=60):
+        """
+        :param base_url: URL of the JSON API
+        :param timeout: connect and read timeout of requests in seconds
+        :param ttl: how long a result is reused, in seconds
+        """
+        self.base_url = base_url.rstrip("/") + "/"
+        self.timeout = timeout
+        self.ttl = ttl
+
+    @classmethod
+    def get_session(cls):
+        """
+        :return: ConditionalSession shared by the process
+        """
+        with cls._lock:
+            if cls._session is None:
+                cls._session = ConditionalSession()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+                cls._session.mount("https://", adapter)
+                cls._session.mount("http://", adapter)
+            return cls._session
+
+    def _lookup(self, url, extract):
+        """
+        Get a JSON document and extract the result from it
+
+        :param url: URL of the document
+        :param extract: function called with the document or None (404)
+        :return: result of extract
+        """
+        with self._lock:
+            lock = self._locks.setdefault(url, threading.Lock())
+        with lock:
+            with self._lock:
+                cached = self._results.get(url)
+            if cached and cached[0] > time.monotonic():
+                metrics.inc("pypi_lookup_reused")
+                return cached[1]
+            response = self.get_session().get(
+                url, headers={"Accept": "application/json"}, timeout=self.timeout
+            )
+            if response.status_code == 200:
+                result = extract(response.json())
+            elif response.status_code == 404:
+                result = extract(None)
+            else:
+                raise ReleaseException(
+                    f"Error getting {url} from PyPi:\n{response.text}"
+                )
+            metrics.inc("pypi_lookup")
+            now = time.monotonic()
+            with self._lock:
+                self._prune(now)
+                self._results[url] = (now + self.ttl, result)
+            return result
+
+    @classmethod
+    def _prune(cls, now):
+        """
+        Drop expired results and locks of URLs nobody is looking up,
+        so that a long-running process doesn't keep every URL it has seen.
+        Called with _lock held.
+        """
+        for url, (expiration, _) in list(cls._results.items()):
+            if expiration <= now:
+                del cls._results[url]
+        for url, lock in list(cls._locks.items()):
+            if url not in cls._results and not lock.locked():
+                del cls._locks[url]
+
+    def latest_version(self, project):
+        """
+        :return: latest version of the project or 0.0.0
+        """
+        return self._lookup(
+            f"{self.base_url}{project}/json",
+            lambda data: data["info"]["version"] if data else "0.0.0",
+        )
+
+    def version_exists(self, project, version):
+        """
+        Check the exact version, its document is small even for projects
+        with many releases
+
+        :return: True if the version of the project is on PyPI
+        """
+        return self._lookup(
+            f"{self.base_url}{project}/{version}/json", lambda data: data is not None
+        )
+
+    def invalidate(self, project):
+        """
+        Forget results of lookups of the project, e.g. after it was uploaded
+        """
+        prefix = f"{self.base_url}{project}/"
+        with self._lock:
+            for url in [url for url in self._results if url.startswith(prefix)]:
+                del self._results[url]
 
 
 class PyPi:
 
     PYPI_URL = "https://pypi.org/pypi/"
+    # simple indexes of the public upload URLs
+    SIMPLE_INDEXES = {
+        "https://upload.pypi.org/legacy/": "https://pypi.org/simple/",
+        "https://test.pypi.org/legacy/": "https://test.pypi.org/simple/",
+    }
 
     def __init__(self, configuration, git):
         """
@@ -34,61 +187,321 @@ class PyPi:
         self.conf = configuration
         self.logger = configuration.logger
         self.git = git
+        self.client = PyPiClient(self.PYPI_URL)
+        self.state = get_state_store(configuration.state_db)
+        self.repository = (
+            f"{configuration.repository_owner}/{configuration.repository_name}"
+        )
 
     def latest_version(self):
         """Get latest version of the package from PyPi or 0.0.0"""
-        response = requests.get(url=f"{self.PYPI_URL}{self.conf.pypi_project}/json")
-        if response.status_code == 200:
-            return response.json()["info"]["version"]
-        elif response.status_code == 404:
-            return "0.0.0"
-        else:
-            msg = f"Error getting latest version from PyPi:\n{response.text}"
-            raise ReleaseException(msg)
+        return self.client.latest_version(self.conf.pypi_project)
+
+    def version_exists(self, version):
+        """Check whether the version of the package is on PyPi"""
+        return self.client.version_exists(self.conf.pypi_project, version)
 
     @staticmethod
-    def build_sdist(project_root):
+    def build_distribution(source_dir, distribution, output_dir):
         """
-        Builds source distribution out of setup.py
+        Builds a distribution with the PEP 517 backend of the project
+        in an isolated environment
 
-        :param project_root: location of setup.py
+        :param source_dir: project or unpacked sdist directory
+        :param distribution: "sdist" or "wheel"
+        :param output_dir: directory to put the distribution in
+        :return: path to the distribution
         """
-        if os.path.isfile(os.path.join(project_root, "setup.py")):
-            run_command(project_root, "python3 setup.py sdist", "Cannot build sdist:")
-        else:
-            raise ReleaseException("Cannot find setup.py:")
+        with DefaultIsolatedEnv() as env:
+            builder = ProjectBuilder.from_isolated_env(env, source_dir)
+            env.install(builder.build_system_requires)
+            env.install(builder.get_requires_for_build(distribution))
+            return builder.build(distribution, output_dir)
+
+    def get_build_cache_dir(self):
+        """
+        Directory with artifacts of previous builds: build_cache_dir
+        from configuration or release-bot/builds in the user cache directory,
+        so that retries and other workers of the machine reuse the builds
+        """
+        if self.conf.build_cache_dir:
+            return self.conf.build_cache_dir
+        cache_home = os.getenv("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+        return os.path.join(cache_home, "release-bot", "builds")
 
     @staticmethod
-    def build_wheel(project_root):
+    def is_version_from_git(project_root):
+        """
+        Whether the version of the project is derived from git (tags),
+        e.g. by setuptools_scm, so that the same tree may build different versions
+
+        :param project_root: location of setup.py or pyproject.toml
+        :return: bool
         """
-        Builds wheel for specified version of python
+        for name in ("setup.py", "setup.cfg", "pyproject.toml"):
+            try:
+                with open(os.path.join(project_root, name)) as file:
+                    content = file.read()
+            except OSError:
+                continue
+            if any(plugin in content for plugin in VERSION_FROM_GIT):
+                return True
+        return False
 
-        :param project_root: location of setup.py
+    def get_build_key(self, project_root):
         """
-        if not os.path.isfile(os.path.join(project_root, "setup.py")):
-            raise ReleaseException("Cannot find setup.py:")
+        Key of the distributions in the build cache: git tree hash of HEAD,
+        with git describe if the version is derived from git
 
-        run_command(project_root, "python3 setup.py bdist_wheel", "Cannot build wheel:")
+        :param project_root: location of setup.py or pyproject.toml
+        :return: str or None if the build can't be cached
+        """
+        tree = self.git.get_tree_hash()
+        if not tree or not self.is_version_from_git(project_root):
+            return tree
+        description = self.git.describe()
+        return f"{tree}-{description}" if description else None
 
-    def upload(self, project_root):
+    def evict_builds(self, cache_dir):
         """
-        Uploads the package distribution to PyPi
+        Remove least recently used builds over BUILD_CACHE_ENTRIES
+        """
+        builds = []
+        for name in os.listdir(cache_dir):
+            try:
+                builds.append((os.path.getmtime(os.path.join(cache_dir, name)), name))
+            except OSError:
+                pass  # evicted by someone else
+        for _, name in sorted(builds, reverse=True)[BUILD_CACHE_ENTRIES:]:
+            shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
 
-        :param project_root: directory with dist/ folder
+    def build_artifacts(self, project_root, output_dir):
         """
-        if os.path.isdir(os.path.join(project_root, "dist")):
-            spec_files = glob(os.path.join(project_root, "dist/*"))
-            files = ""
-            for file in spec_files:
-                files += f"{file} "
-            self.logger.debug(f"Uploading {files} to PyPi")
-            run_command(
-                project_root,
-                f"twine upload {files}",
-                "Cannot upload python distribution:",
+        Builds sdist and then a wheel from the unpacked sdist,
+        the same as python -m build
+
+        :param project_root: location of setup.py or pyproject.toml
+        :param output_dir: directory to put the distributions in
+        """
+        start = time.monotonic()
+        sdist = self.build_distribution(project_root, "sdist", output_dir)
+        elapsed = time.monotonic() - start
+        metrics.inc("pypi_build_sdist_seconds", elapsed)
+        self.logger.info(f"Built {os.path.basename(sdist)} in {elapsed:.1f} s")
+
+        start = time.monotonic()
+        with tempfile.TemporaryDirectory() as unpacked:
+            with tarfile.open(sdist) as tar:
+                if hasattr(tarfile, "data_filter"):
+                    tar.extractall(unpacked, filter="data")
+                else:
+                    tar.extractall(unpacked)
+            source_dir = os.path.join(
+                unpacked, os.path.basename(sdist)[: -len(".tar.gz")]
             )
+            wheel = self.build_distribution(source_dir, "wheel", output_dir)
+        elapsed = time.monotonic() - start
+        metrics.inc("pypi_build_wheel_seconds", elapsed)
+        self.logger.info(f"Built {os.path.basename(wheel)} in {elapsed:.1f} s")
+
+    def build(self, project_root):
+        """
+        Builds sdist and wheel into dist/, the distributions are cached
+        by git tree hash of HEAD (see get_build_key) and reused
+        when the same tree is built again
+
+        :param project_root: location of setup.py or pyproject.toml
+        :return: list of paths to the distributions
+        """
+        if not any(
+            os.path.isfile(os.path.join(project_root, name))
+            for name in ("setup.py", "pyproject.toml")
+        ):
+            raise ReleaseException("Cannot find setup.py or pyproject.toml:")
+
+        cache_dir = self.get_build_cache_dir()
+        os.makedirs(cache_dir, exist_ok=True)
+        key = self.get_build_key(project_root)
+        artifacts_dir = os.path.join(cache_dir, key or f".uncached-{os.getpid()}")
+        if key and os.path.isdir(artifacts_dir):
+            self.logger.info(f"Reusing distributions built from {key}")
+            metrics.inc("pypi_build_cache_hit")
+            os.utime(artifacts_dir)
         else:
+            metrics.inc("pypi_build_cache_miss")
+            output_dir = tempfile.mkdtemp(dir=cache_dir, prefix=".build-")
+            try:
+                self.build_artifacts(project_root, output_dir)
+            except Exception as exc:
+                shutil.rmtree(output_dir)
+                raise ReleaseException(f"Cannot build python distribution: {exc!r}")
+            if not key:
+                shutil.rmtree(artifacts_dir, ignore_errors=True)
+            try:
+                os.rename(output_dir, artifacts_dir)
+            except OSError:
+                # the same tree was built by someone else meanwhile
+                shutil.rmtree(output_dir)
+            self.evict_builds(cache_dir)
+
+        dist = os.path.join(project_root, "dist")
+        os.makedirs(dist, exist_ok=True)
+        return [
+            shutil.copy2(os.path.join(artifacts_dir, name), dist)
+            for name in sorted(os.listdir(artifacts_dir))
+        ]
+
+    def get_index_url(self, repository_url):
+        """
+        Simple index of the repository distributions are uploaded to
+
+        :param repository_url: URL distributions are uploaded to
+        :return: pypi_index_url, index of PyPI or TestPyPI or None if unknown
+        """
+        if self.conf.pypi_index_url:
+            return self.conf.pypi_index_url
+        return self.SIMPLE_INDEXES.get(repository_url.rstrip("/") + "/")
+
+    def get_index_files(self, index_url, project):
+        """
+        Files of the project which are already on the package index
+
+        :param index_url: URL of the simple index
+        :param project: name of the project on the index
+        :return: set of file names
+        """
+        name = re.sub(r"[-_.]+", "-", project).lower()
+        url = f"{index_url.rstrip('/')}/{name}/"
+        try:
+            response = PyPiClient.get_session().get(url, timeout=(5, 30))
+        except requests.RequestException as exc:
+            self.logger.warning(f"Cannot list files on the package index: {exc}")
+            return set()
+        if response.status_code != 200:
+            return set()
+        return {
+            os.path.basename(unquote(href))
+            for href in re.findall(r'href="([^"#]+)', response.text)
+        }
+
+    def upload_file(self, repository, package):
+        """
+        Uploads one distribution
+
+        :param repository: twine Repository
+        :param package: twine PackageFile
+        :return: "uploaded" or "exists"
+        """
+        response = repository.upload(package)
+        if response.status_code == 200:
+            return "uploaded"
+        # the file was uploaded by an attempt which didn't get the response
+        if response.status_code == 409 or (
+            response.status_code == 400 and "exist" in response.text.lower()
+        ):
+            return "exists"
+        raise ReleaseException(
+            f"Cannot upload {package.basefilename}: "
+            f"{response.status_code} {response.reason}"
+        )
+
+    def upload(self, project_root):
+        """
+        Uploads the package distributions to PyPi in parallel, skipping files
+        the index already has or which were uploaded by a previous attempt
+
+        :param project_root: directory with dist/ folder
+        """
+        if not os.path.isdir(os.path.join(project_root, "dist")):
             raise ReleaseException("dist/ folder cannot be found:")
+        files = sorted(glob(os.path.join(project_root, "dist/*")))
+        if not files:
+            raise ReleaseException("dist/ folder is empty:")
+
+        # like twine upload: credentials from environment or ~/.pypirc
+        settings = Settings(
+            username=os.environ.get("TWINE_USERNAME"),
+            password=os.environ.get("TWINE_PASSWORD"),
+            repository_url=self.conf.pypi_repository_url or None,
+            non_interactive=True,
+            disable_progress_bar=True,
+        )
+        repository_url = settings.repository_config["repository"]
+
+        packages = [PackageFile.from_filename(file, None) for file in files]
+        version = packages[0].version
+        status = self.state.get_upload_status(self.repository, version)
+        done = {name for name, result in status.items() if result != "failed"}
+        index_url = self.get_index_url(repository_url)
+        if index_url:
+            for project in {package.safe_name for package in packages}:
+                done |= self.get_index_files(index_url, project)
+        else:
+            self.logger.debug(
+                f"Simple index of {repository_url} is not known, "
+                "set pypi_index_url to skip files which are already there"
+            )
+        pending = [package for package in packages if package.basefilename not in done]
+        for package in packages:
+            if package not in pending:
+                self.logger.info(f"{package.basefilename} is already uploaded")
+        if not pending:
+            return
+
+        repository = settings.create_repository()
+        workers = min(len(pending), UPLOAD_WORKERS)
+        # one pool of keep-alive connections shared by all workers
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+        repository.session.mount("https://", adapter)
+        repository.session.mount("http://", adapter)
+
+        def upload(package):
+            self.logger.debug(f"Uploading {package.basefilename} to PyPi")
+            try:
+                result = self.upload_file(repository, package)
+            except Exception as exc:
+                self.state.set_upload_status(
+                    self.repository, version, package.basefilename, "failed"
+                )
+                return exc
+            self.state.set_upload_status(
+                self.repository, version, package.basefilename, result
+            )
+            metrics.inc(f"pypi_files_{result}")
+            return None
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                errors = [error for error in executor.map(upload, pending) if error]
+        finally:
+            repository.close()
+        if errors:
+            raise ReleaseException(
+                "Cannot upload python distribution:\n"
+                + "\n".join(str(error) for error in errors)
+            )
+        self.client.invalidate(self.conf.pypi_project)
+
+    def prebuild(self):
+        """
+        Builds and checks distributions of the checked out tree ahead
+        of the release, the release of the same tree then only uploads
+        them from the build cache
+
+        :return: True if the distributions were built and passed twine check
+        """
+        project_root = self.git.repo_path
+        distributions = self.build(project_root)
+        try:
+            failed = twine_check(distributions)
+        finally:
+            shutil.rmtree(os.path.join(project_root, "dist"), ignore_errors=True)
+        if failed:
+            self.logger.warning("Pre-built distributions didn't pass twine check")
+            metrics.inc("pypi_prebuild_failed")
+            return False
+        metrics.inc("pypi_prebuild")
+        return True
 
     def release(self):
         """
@@ -100,8 +513,7 @@ class PyPi:
                 self.logger.debug("cleaning up dist/")
                 shutil.rmtree(os.path.join(project_root, "dist"))
             self.logger.debug("About to release on PyPi")
-            self.build_sdist(project_root)
-            self.build_wheel(project_root)
+            self.build(project_root)
             if self.conf.dry_run:
                 return False
             self.upload(project_root)
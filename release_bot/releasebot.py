@@ -19,10 +19,11 @@ into various downstream services
 """
 import logging
 import time
+from datetime import datetime
 from sys import exit
 
 from flask import Flask
-from ogr.abstract import IssueStatus, PRStatus
+from ogr.abstract import PRStatus
 from semantic_version import Version
 
 from release_bot.cli import CLI
@@ -31,16 +32,18 @@ from release_bot.exceptions import ReleaseException
 from release_bot.git import Git
 from release_bot.github import Github
 from release_bot.init_repo import Init
+from release_bot.metrics import metrics
 from release_bot.new_pr import NewPR
 from release_bot.new_release import NewRelease
 from release_bot.pypi import PyPi
+from release_bot.state import get_state_store
 from release_bot.utils import (
     process_version_from_title,
     GitService,
     which_service,
     which_username,
 )
-from release_bot.webhooks import GithubWebhooksHandler
+from release_bot.webhooks import GithubWebhooksHandler, MetricsHandler
 
 
 class ReleaseBot:
@@ -54,6 +57,8 @@ class ReleaseBot:
         self.new_pr = NewPR()
         self.project = configuration.project
         self.git_service = which_service(self.project)  # Github/Pagure
+        self.repository = f"{self.conf.repository_owner}/{self.conf.repository_name}"
+        self.state = get_state_store(self.conf.state_db)
 
     def cleanup(self):
         self.new_release = NewRelease()
@@ -74,17 +79,31 @@ class ReleaseBot:
                 "POST",
             ],
         )
+        app.add_url_rule(
+            "/metrics", view_func=MetricsHandler.as_view("metrics"), methods=["GET"]
+        )
         app.run(host="0.0.0.0", port=8080)
 
+    def get_repository_file(self, name):
+        """
+        Read a file from the default branch: from the clone if there is one,
+        otherwise via API so that the repository doesn't have to be cloned
+        :param name: path to the file
+        :return: file content or None
+        """
+        if self.git.is_cloned:
+            return self.git.read_file(f"origin/{self.project.default_branch}", name)
+        return self.github.get_file(name)
+
     def load_release_conf(self):
         """
         Updates new_release with latest release-conf.yaml from repository
         :return:
         """
         # load release configuration from release-conf.yaml in repository
-        conf = self.github.get_file("release-conf.yaml")
+        conf = self.get_repository_file("release-conf.yaml")
         release_conf = self.conf.load_release_conf(conf)
-        setup_cfg = self.github.get_file("setup.cfg")
+        setup_cfg = self.get_repository_file("setup.cfg")
         self.conf.set_pypi_project(release_conf, setup_cfg)
 
         self.new_release.update(
@@ -94,6 +113,9 @@ class ReleaseBot:
             pypi=release_conf.get("pypi"),
             trigger_on_issue=release_conf.get("trigger_on_issue"),
             labels=release_conf.get("labels"),
+            version_files_include=release_conf.get("version_files_include"),
+            version_files_exclude=release_conf.get("version_files_exclude"),
+            version_files=release_conf.get("version_files"),
         )
 
     def find_open_release_issues(self):
@@ -103,11 +125,13 @@ class ReleaseBot:
         """
         release_issues = {}
         latest_version = Version(self.github.latest_release())
-        opened_issues = self.project.get_issue_list(IssueStatus.open)
+        opened_issues = self.github.snapshot.open_issues
         if not opened_issues:
             self.logger.debug("No more open issues found")
         else:
             for issue in opened_issues:
+                if self.state.is_processed(self.repository, "issue", issue.id):
+                    continue
                 match, version = process_version_from_title(issue.title, latest_version)
                 if match:
                     if issue.can_close(which_username(self.conf)):
@@ -147,7 +171,10 @@ class ReleaseBot:
         :return: bool, whether PR was found
         """
         latest_version = Version(self.github.latest_release())
-        merged_prs = self.github.walk_through_prs(PRStatus.merged)
+        if self.git_service == GitService.Github:
+            merged_prs = self.find_merged_release_prs_since_watermark(latest_version)
+        else:
+            merged_prs = self.github.walk_through_prs(PRStatus.merged)
 
         if not merged_prs:
             self.logger.debug("No merged release PR found")
@@ -167,6 +194,34 @@ class ReleaseBot:
                 )
                 return True
 
+    def find_merged_release_prs_since_watermark(self, latest_version):
+        """
+        Classify only PRs merged since the previous cycle and remember
+        the newest merged release PR, so that the whole merged PR history
+        doesn't have to be read on every cycle
+
+        :param latest_version: the current latest version with type Version()
+        :return: list with the newest merged release PR or empty list
+        """
+        watermark = self.state.get_watermark(self.repository, "merged_prs")
+        merged_prs, new_watermark = self.github.get_merged_prs_since(
+            datetime.fromisoformat(watermark) if watermark else None
+        )
+        newest_release_pr = self.state.get_newest_release_pr(self.repository)
+        for merged_pr in merged_prs:
+            match, _ = process_version_from_title(merged_pr.title, latest_version)
+            if match and (
+                not newest_release_pr
+                or merged_pr.merged_at > newest_release_pr.merged_at
+            ):
+                newest_release_pr = merged_pr
+                self.state.save_release_pr(self.repository, merged_pr)
+        if new_watermark:
+            self.state.set_watermark(
+                self.repository, "merged_prs", new_watermark.isoformat()
+            )
+        return [newest_release_pr] if newest_release_pr else []
+
     def make_release_pull_request(self):
         """
         Makes release pull request and handles outcome
@@ -190,7 +245,14 @@ class ReleaseBot:
             self.project.get_issue(self.new_pr.issue_number).comment(msg)
             self.github.comment = comment_backup
             if success:
+                self.state.mark_processed(
+                    self.repository,
+                    "issue",
+                    self.new_pr.issue_number,
+                    self.new_pr.version,
+                )
                 self.project.get_issue(self.new_pr.issue_number).close()
+                self.github.snapshot.invalidate("open_issues")
                 self.logger.debug(f"Closed issue #{self.new_pr.issue_number}")
 
         latest_gh_str = self.github.latest_release()
@@ -198,6 +260,9 @@ class ReleaseBot:
         if Version.coerce(latest_gh_str) >= Version.coerce(self.new_pr.version):
             msg = f"Version ({latest_gh_str}) is already released and this issue is ignored."
             self.logger.warning(msg)
+            self.state.mark_processed(
+                self.repository, "issue", self.new_pr.issue_number
+            )
             return False
         msg = (
             f"Making a new PR for release of version "
@@ -206,18 +271,48 @@ class ReleaseBot:
         if not self.conf.dry_run:
             self.logger.info(msg)
 
+        self.new_pr.version_files_include = self.new_release.version_files_include
+        self.new_pr.version_files_exclude = self.new_release.version_files_exclude
+        self.new_pr.version_files = self.new_release.version_files
+        self.new_pr.cached_version_files = self.state.get_version_files(self.repository)
         try:
             self.new_pr.repo = self.git
             if not self.new_pr.repo:
                 raise ReleaseException("Couldn't clone repository!")
             if self.github.make_release_pr(self.new_pr, self.conf.gitchangelog):
+                if not self.new_pr.version_files and self.new_pr.changed_version_files:
+                    self.state.set_version_files(
+                        self.repository, self.new_pr.changed_version_files
+                    )
                 pr_handler(success=True)
+                if self.conf.prebuild and self.new_release.pypi:
+                    self.prebuild_distributions(f"{self.new_pr.version}-release")
                 return True
         except ReleaseException:
             pr_handler(success=False)
             raise
         return False
 
+    def prebuild_distributions(self, branch):
+        """
+        Build distributions of the release branch while the PR waits for merge,
+        failures are only logged, the release builds again if needed
+        :param branch: release branch
+        """
+        if self.pypi.is_version_from_git(self.git.repo_path):
+            # the untagged release branch would build another version
+            self.logger.info("Version is derived from git, not pre-building")
+            return
+        self.logger.info(f"Pre-building distributions of {branch}")
+        try:
+            try:
+                self.git.checkout(branch)
+                self.pypi.prebuild()
+            finally:
+                self.git.checkout(self.project.default_branch)
+        except Exception as exc:
+            self.logger.warning(f"Pre-building distributions failed: {exc!r}")
+
     def make_new_github_release(self):
         def release_handler(success):
             result = "released" if success else "failed to release"
@@ -226,6 +321,12 @@ class ReleaseBot:
             self.logger.log(level, msg)
             self.github.comment.append(msg)
 
+        if self.state.is_published(self.repository, "github", self.new_release.version):
+            self.logger.debug(
+                f"{self.new_release.version} is known to be released on {self.git_service.name}"
+            )
+            return self.new_release
+
         try:
             latest_release = self.github.latest_release()
         except ReleaseException as exc:
@@ -237,6 +338,9 @@ class ReleaseBot:
             self.logger.info(
                 f"{self.new_release.version} has already been released on {self.git_service.name}"
             )
+            self.state.mark_published(
+                self.repository, "github", self.new_release.version
+            )
         else:
             try:
                 if self.conf.dry_run:
@@ -245,6 +349,9 @@ class ReleaseBot:
                     self.new_release
                 )
                 if released:
+                    self.state.mark_published(
+                        self.repository, "github", self.new_release.version
+                    )
                     release_handler(success=True)
             except ReleaseException:
                 release_handler(success=False)
@@ -266,6 +373,17 @@ class ReleaseBot:
             self.logger.log(level, msg)
             self.github.comment.append(msg)
 
+        if self.state.is_published(self.repository, "pypi", self.new_release.version):
+            self.logger.debug(f"{self.new_release.version} is known to be on PyPi")
+            return False
+
+        if self.pypi.version_exists(self.new_release.version):
+            self.logger.info(
+                f"{self.conf.pypi_project}-{self.new_release.version} "
+                f"has already been released on PyPi"
+            )
+            self.state.mark_published(self.repository, "pypi", self.new_release.version)
+            return False
         latest_pypi = self.pypi.latest_version()
         if Version.coerce(latest_pypi) >= Version.coerce(self.new_release.version):
             msg = (
@@ -273,12 +391,14 @@ class ReleaseBot:
                 f"or higher version has already been released on PyPi"
             )
             self.logger.info(msg)
+            self.state.mark_published(self.repository, "pypi", self.new_release.version)
             return False
         self.git.fetch_tags()
         self.git.checkout(self.new_release.version)
         try:
             if self.pypi.release() is False:
                 return False
+            self.state.mark_published(self.repository, "pypi", self.new_release.version)
             release_handler(success=True)
         except ReleaseException:
             release_handler(success=False)
@@ -288,44 +408,75 @@ class ReleaseBot:
 
         return True
 
+    def is_release_complete(self):
+        """
+        Whether the version of the found release PR is published everywhere
+        :return: bool
+        """
+        version = self.new_release.version
+        return self.state.is_published(self.repository, "github", version) and (
+            not self.new_release.pypi
+            or self.state.is_published(self.repository, "pypi", version)
+        )
+
+    def refresh_credentials(self):
+        """
+        Renew the expiring token of the Github app in the remote url,
+        the credential store and the API session before a cycle
+        """
+        if self.conf.refresh_github_app_token():
+            self.logger.debug("Github app token renewed")
+            self.git.set_url(self.conf.clone_url)
+            self.github.set_token(self.conf.github_token)
+
+    def reconcile(self):
+        """
+        Run one reconcile cycle: release merged release PRs
+        and make release PRs from release issues
+        """
+        self.refresh_credentials()
+        self.github.refresh_snapshot()
+        self.git.pull_branch(self.project.default_branch)
+        self.logger.debug(
+            f"git pulls skipped so far: {metrics.get('git_pull_skipped')}, "
+            f"performed: {metrics.get('git_pull_performed')}"
+        )
+        try:
+            self.load_release_conf()
+            if self.find_newest_release_pull_request():
+                self.make_new_github_release()
+                # Try to do PyPi release regardless whether we just did github release
+                # for case that in previous iteration (of the 'while True' loop)
+                # we succeeded with github release, but failed with PyPi release
+                self.make_new_pypi_release()
+        except ReleaseException as exc:
+            self.logger.error(exc)
+
+        # Moved out of the previous try-except block, because if it
+        # encounters ReleaseException while checking for PyPi sources
+        # it doesn't check for GitHub issues.
+        try:
+            if self.new_release.trigger_on_issue and self.find_open_release_issues():
+                if self.new_release.labels is not None:
+                    self.project.add_issue_labels(
+                        self.new_pr.issue_number, self.new_release.labels
+                    )
+                self.make_release_pull_request()
+        except ReleaseException as exc:
+            self.logger.error(exc)
+
+        if self.github.comment:
+            msg = "\n".join(self.github.comment)
+            self.project.pr_comment(self.new_release.pr_number, msg)
+            self.github.comment = []  # clean up
+
     def run(self):
-        self.logger.info(f"release-bot v{configuration.version} reporting for duty!")
+        self.logger.info(f"release-bot v{self.conf.version} reporting for duty!")
         if self.conf.dry_run:
             self.logger.info("Running in dry-run mode.")
         try:
             while True:
-                self.git.pull_branch(self.project.default_branch)
-                try:
-                    self.load_release_conf()
-                    if self.find_newest_release_pull_request():
-                        self.make_new_github_release()
-                        # Try to do PyPi release regardless whether we just did github release
-                        # for case that in previous iteration (of the 'while True' loop)
-                        # we succeeded with github release, but failed with PyPi release
-                        self.make_new_pypi_release()
-                except ReleaseException as exc:
-                    self.logger.error(exc)
-
-                # Moved out of the previous try-except block, because if it
-                # encounters ReleaseException while checking for PyPi sources
-                # it doesn't check for GitHub issues.
-                try:
-                    if (
-                        self.new_release.trigger_on_issue
-                        and self.find_open_release_issues()
-                    ):
-                        if self.new_release.labels is not None:
-                            self.project.add_issue_labels(
-                                self.new_pr.issue_number, self.new_release.labels
-                            )
-                        self.make_release_pull_request()
-                except ReleaseException as exc:
-                    self.logger.error(exc)
-
-                if self.github.comment:
-                    msg = "\n".join(self.github.comment)
-                    self.project.pr_comment(self.new_release.pr_number, msg)
-                    self.github.comment = []  # clean up
+                self.reconcile()
 
                 if not self.conf.refresh_interval:
                     self.logger.debug(
@@ -351,6 +502,10 @@ def main():
         configuration.load_configuration()
         if configuration.webhook_handler:
             ReleaseBot.create_flask_instance(configuration)
+        elif configuration.daemon or configuration.repositories:
+            from release_bot.daemon import Daemon
+
+            Daemon(configuration).run()
         else:
             rb = ReleaseBot(configuration)
             rb.run()
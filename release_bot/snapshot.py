@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module provides a per-cycle snapshot of the project state on the git forge
+"""
+from ogr.abstract import IssueStatus, PRStatus
+from semantic_version import Version
+
+
+class ForgeSnapshot:
+    """
+    Read-only view of a project on Github/Pagure, valid for one reconcile cycle.
+
+    Every list is fetched from the forge at most once, on first access.
+    Call invalidate() after the bot itself changes something on the forge.
+    """
+
+    def __init__(self, project):
+        """
+        :param project: ogr-lib GitProject instance
+        """
+        self.project = project
+        self._cache = {}
+
+    def _get(self, key, fetch):
+        if key not in self._cache:
+            self._cache[key] = fetch()
+        return self._cache[key]
+
+    def invalidate(self, *keys):
+        """
+        Drop cached data so that it is fetched again on next access
+        :param keys: names of the properties to drop, all of them if empty
+        """
+        if not keys:
+            self._cache.clear()
+        for key in keys:
+            self._cache.pop(key, None)
+
+    @property
+    def releases(self):
+        """List of releases sorted by version, the newest is the last one"""
+
+        def fetch():
+            releases = list(self.project.get_releases() or [])
+            releases.sort(key=lambda release: Version(release.title))
+            return releases
+
+        return self._get("releases", fetch)
+
+    @property
+    def latest_release(self):
+        """Release with the highest version or None"""
+        return self.releases[-1] if self.releases else None
+
+    @property
+    def open_issues(self):
+        return self._get(
+            "open_issues", lambda: self.project.get_issue_list(IssueStatus.open)
+        )
+
+    @property
+    def merged_prs(self):
+        return self._get(
+            "merged_prs", lambda: self.project.get_pr_list(PRStatus.merged)
+        )
+
+    @property
+    def open_prs(self):
+        return self._get("open_prs", lambda: self.project.get_pr_list(PRStatus.open))
+
+    @property
+    def branches(self):
+        return self._get("branches", self.project.get_branches)
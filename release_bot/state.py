@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+This module provides persistent state of the bot between cycles and tasks
+"""
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from release_bot.github import MergedPR
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS processed (
+    repository TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    version TEXT,
+    PRIMARY KEY (repository, kind, number)
+);
+CREATE TABLE IF NOT EXISTS release_prs (
+    repository TEXT NOT NULL,
+    pr_number INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    author TEXT,
+    merged_at TEXT NOT NULL,
+    PRIMARY KEY (repository, pr_number)
+);
+CREATE TABLE IF NOT EXISTS published_versions (
+    repository TEXT NOT NULL,
+    target TEXT NOT NULL,
+    version TEXT NOT NULL,
+    PRIMARY KEY (repository, target, version)
+);
+CREATE TABLE IF NOT EXISTS uploads (
+    repository TEXT NOT NULL,
+    version TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    status TEXT NOT NULL,
+    PRIMARY KEY (repository, filename)
+);
+CREATE TABLE IF NOT EXISTS version_files (
+    repository TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (repository, path)
+);
+CREATE TABLE IF NOT EXISTS watermarks (
+    repository TEXT NOT NULL,
+    name TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (repository, name)
+);
+"""
+
+
+class StateStore:
+    """
+    SQLite store of what the bot has already done: processed issues and PRs,
+    merged release PRs, versions published per target, status of uploaded
+    distributions, files where the version was found in the last release
+    and watermarks.
+
+    One connection is shared by all threads of a process. Several processes
+    may use the same file: the database runs in WAL mode, waits for locks
+    held by other processes and takes the write lock at the start
+    of every write transaction.
+    """
+
+    def __init__(self, path=":memory:"):
+        """
+        :param path: path to the database file, in-memory database by default
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        if path != ":memory:":
+            self._connection.execute("PRAGMA journal_mode=WAL")
+        with self._transaction() as connection:
+            for statement in SCHEMA.split(";"):
+                if statement.strip():
+                    connection.execute(statement)
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._connection
+            except Exception:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
+
+    def _query(self, sql, *params):
+        with self._lock:
+            return self._connection.execute(sql, params).fetchone()
+
+    def is_processed(self, repository, kind, number):
+        """
+        :param kind: "issue" or "pr"
+        :param number: issue or PR number
+        """
+        return bool(
+            self._query(
+                "SELECT 1 FROM processed "
+                "WHERE repository = ? AND kind = ? AND number = ?",
+                repository,
+                kind,
+                number,
+            )
+        )
+
+    def mark_processed(self, repository, kind, number, version=None):
+        with self._transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO processed VALUES (?, ?, ?, ?)",
+                (repository, kind, number, version),
+            )
+
+    def get_newest_release_pr(self, repository):
+        """
+        :return: MergedPR merged as the last one or None
+        """
+        row = self._query(
+            "SELECT pr_number, title, author, merged_at FROM release_prs "
+            "WHERE repository = ? ORDER BY merged_at DESC LIMIT 1",
+            repository,
+        )
+        if not row:
+            return None
+        return MergedPR(row[0], row[1], row[2], datetime.fromisoformat(row[3]))
+
+    def save_release_pr(self, repository, merged_pr):
+        """
+        :param merged_pr: MergedPR
+        """
+        with self._transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO release_prs VALUES (?, ?, ?, ?, ?)",
+                (
+                    repository,
+                    merged_pr.id,
+                    merged_pr.title,
+                    merged_pr.author,
+                    merged_pr.merged_at.isoformat(),
+                ),
+            )
+
+    def is_published(self, repository, target, version):
+        """
+        :param target: where the version is published, e.g. "github", "pypi"
+        """
+        return bool(
+            self._query(
+                "SELECT 1 FROM published_versions "
+                "WHERE repository = ? AND target = ? AND version = ?",
+                repository,
+                target,
+                version,
+            )
+        )
+
+    def mark_published(self, repository, target, version):
+        with self._transaction() as connection:
+            connection.execute(
+                "INSERT OR IGNORE INTO published_versions VALUES (?, ?, ?)",
+                (repository, target, version),
+            )
+
+    def get_upload_status(self, repository, version):
+        """
+        :return: dict, file name -> status of its upload
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT filename, status FROM uploads "
+                "WHERE repository = ? AND version = ?",
+                (repository, version),
+            ).fetchall()
+        return dict(rows)
+
+    def set_upload_status(self, repository, version, filename, status):
+        """
+        :param status: e.g. "uploaded", "exists", "failed"
+        """
+        with self._transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?)",
+                (repository, version, filename, status),
+            )
+
+    def get_version_files(self, repository):
+        """
+        :return: list of paths where the version was updated in the last release
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT path FROM version_files WHERE repository = ? ORDER BY path",
+                (repository,),
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def set_version_files(self, repository, paths):
+        with self._transaction() as connection:
+            connection.execute(
+                "DELETE FROM version_files WHERE repository = ?", (repository,)
+            )
+            connection.executemany(
+                "INSERT INTO version_files VALUES (?, ?)",
+                [(repository, path) for path in paths],
+            )
+
+    def get_watermark(self, repository, name):
+        """
+        :return: str or None
+        """
+        row = self._query(
+            "SELECT value FROM watermarks WHERE repository = ? AND name = ?",
+            repository,
+            name,
+        )
+        return row[0] if row else None
+
+    def set_watermark(self, repository, name, value):
+        with self._transaction() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO watermarks VALUES (?, ?, ?)",
+                (repository, name, value),
+            )
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_state_store(path=None):
+    """
+    Get the process-wide StateStore for the database file
+    :param path: path to the database file, in-memory database if empty
+    :return: StateStore instance
+    """
+    path = str(path) if path else ":memory:"
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = StateStore(path)
+        return _stores[path]
@@ -19,9 +19,15 @@ import logging
 import os
 import re
 import shlex
+import shutil
+import stat
 import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from enum import IntEnum
+from fnmatch import fnmatch
 
+import redis
 from ogr import GithubService, PagureService
 from semantic_version import validate
 
@@ -63,6 +69,23 @@ def which_username(conf):
     return None
 
 
+# seconds to wait for Redis to connect or answer
+REDIS_TIMEOUT = 2
+
+
+def get_redis_instance():
+    db = redis.Redis(
+        host=os.getenv("REDIS_SERVICE_HOST", "localhost"),
+        port=os.getenv("REDIS_SERVICE_PORT", "6379"),
+        db=1,  # 0 is used by Celery
+        decode_responses=True,
+        # webhooks fall back to memory rather than wait for an unreachable Redis
+        socket_connect_timeout=REDIS_TIMEOUT,
+        socket_timeout=REDIS_TIMEOUT,
+    )
+    return db
+
+
 def set_git_credentials(repo_path, name, email):
     """
     Sets credentials fo git repo to keep git from resisting to commit
@@ -167,7 +190,7 @@ def update_spec(spec_path, new_release):
         spec_file.close()
 
 
-def run_command(work_directory, cmd, error_message, fail=True):
+def run_command(work_directory, cmd, error_message, fail=True, env=None):
     """
     Execute a command
 
@@ -175,6 +198,7 @@ def run_command(work_directory, cmd, error_message, fail=True):
     :param cmd: command
     :param error_message: An error message to return in case of failure
     :param fail: If failure should cause termination of the bot
+    :param env: dict, environment variables to add to the environment of the command
     :return: Boolean indicating success/failure
     """
     cmd = shlex.split(cmd)
@@ -185,6 +209,7 @@ def run_command(work_directory, cmd, error_message, fail=True):
         shell=False,
         cwd=work_directory,
         universal_newlines=True,
+        env={**os.environ, **env} if env else None,
     )
 
     logger.debug(f"{shell.args}\n{shell.stdout}")
@@ -218,9 +243,16 @@ def run_command_get_output(work_directory, cmd):
     return success, shell.stdout
 
 
+# size of chunks the changelog is copied in
+CHANGELOG_CHUNK_SIZE = 1024 * 1024
+
+
 def insert_in_changelog(changelog, version, log):
     """
-    Patches file with new changelog
+    Patches file with new changelog: the new section and then the original
+    content are streamed to a temporary file which replaces the changelog,
+    so memory use doesn't grow with the changelog and the file is never
+    left half-written
     :param changelog: file with changelog
     :param version: current version
     :param log: the changelog to insert
@@ -228,44 +260,96 @@ def insert_in_changelog(changelog, version, log):
     """
     content = f"# {version}\n\n{log}\n"
     try:
-        with open(changelog, "r+") as file:
-            original = file.read()
-            file.seek(0)
-            file.write(content + original)
+        with open(changelog, "rb") as original:
+            mode = os.fstat(original.fileno()).st_mode
+            directory = os.path.dirname(os.path.abspath(changelog))
+            fd, temp_path = tempfile.mkstemp(dir=directory, prefix=".changelog-")
+            try:
+                with os.fdopen(fd, "wb") as temp_file:
+                    temp_file.write(content.encode("utf-8"))
+                    shutil.copyfileobj(original, temp_file, CHANGELOG_CHUNK_SIZE)
+                os.chmod(temp_path, stat.S_IMODE(mode))
+                os.replace(temp_path, changelog)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
             return True
     except FileNotFoundError as exc:
         logger.warning(f"No CHANGELOG.md present in repository\n{exc}")
     return False
 
 
-def look_for_version_files(repo_directory, new_version):
+# names of files which may contain the __version__ variable
+VERSION_FILES = ("setup.py", "setup.cfg", "__about__.py", "__init__.py", "version.py")
+# directories never searched for version files by default
+EXCLUDED_VERSION_FILES = (
+    "node_modules/*",
+    "*/node_modules/*",
+    "vendor/*",
+    "*/vendor/*",
+)
+# files are looked for the word "version" only in this many first bytes
+VERSION_PREFILTER_SIZE = 64 * 1024
+
+
+def list_version_file_candidates(repo_directory, include=None, exclude=None):
+    """
+    List files that may be hiding the __version__ variable: tracked files
+    according to git ls-files, or all files if repo_directory is not a git repository
+    :param repo_directory: repository path
+    :param include: list of globs, only matching paths are candidates
+    :param exclude: list of globs, matching paths are not candidates
+    :return: list of paths relative to repo_directory
+    """
+    success, output = run_command_get_output(repo_directory, "git ls-files -z")
+    if success:
+        files = [path for path in output.split("\0") if path]
+    else:
+        files = []
+        for root, dirs, names in os.walk(repo_directory):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            relative_root = os.path.relpath(root, repo_directory)
+            for name in names:
+                files.append(os.path.normpath(os.path.join(relative_root, name)))
+
+    exclude = tuple(exclude or ()) + EXCLUDED_VERSION_FILES
+    return [
+        path
+        for path in files
+        if os.path.basename(path) in VERSION_FILES
+        and (not include or any(fnmatch(path, glob) for glob in include))
+        and not any(fnmatch(path, glob) for glob in exclude)
+    ]
+
+
+def look_for_version_files(repo_directory, new_version, include=None, exclude=None):
     """
-    Walks through repository and looks for suspects that may be hiding the __version__ variable
+    Looks through repository for suspects that may be hiding the __version__ variable
     For setup.py and setup.cfg it also looks for the version variable
     :param repo_directory: repository path
     :param new_version: version to update to
+    :param include: list of globs, only matching paths are searched
+    :param exclude: list of globs, matching paths are not searched
     :return: list of changed files
     """
-    changed = []
-    for root, _, files in os.walk(repo_directory):
-        for file in files:
-            if file in (
-                "setup.py",
-                "setup.cfg",
-                "__about__.py",
-                "__init__.py",
-                "version.py",
-            ):
-                filename = os.path.join(root, file)
-                if file in ("setup.py", "setup.cfg"):
-                    success = update_version(
-                        filename, new_version, ("__version__", "version")
-                    )
-                else:
-                    success = update_version(filename, new_version, ("__version__"))
 
-                if success:
-                    changed.append(filename.replace(repo_directory + "/", "", 1))
+    def update(path):
+        filename = os.path.join(repo_directory, path)
+        # tracked files may be missing in the working tree, e.g. in a sparse checkout
+        if not os.path.isfile(filename):
+            return False
+        # small files without the word are not parsed and rewritten line by line,
+        # a larger one is left to the parser rather than read in full twice
+        with open(filename, "rb") as candidate:
+            head = candidate.read(VERSION_PREFILTER_SIZE)
+        if b"version" not in head and len(head) < VERSION_PREFILTER_SIZE:
+            return False
+        return update_version_file(filename, new_version)
+
+    candidates = list_version_file_candidates(repo_directory, include, exclude)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = executor.map(update, candidates)
+    changed = [path for path, success in zip(candidates, results) if success]
     if not changed:
         logger.error("No version files found. Aborting version update.")
 
@@ -304,3 +388,89 @@ def update_version(file, new_version, prefix):
             output.write("\n".join(content) + "\n")
         logger.info("Version replaced.")
     return changed
+
+
+def update_version_file(filename, new_version):
+    """
+    Patches __version__ (or also version in setup.py and setup.cfg) in the file
+    :param filename: path to the file
+    :param new_version: version to update the file with
+    :return: True if file was changed, else False
+    """
+    if os.path.basename(filename) in ("setup.py", "setup.cfg"):
+        return update_version(filename, new_version, ("__version__", "version"))
+    return update_version(filename, new_version, ("__version__"))
+
+
+def update_version_by_pattern(file, new_version, pattern):
+    """
+    Patches the version matched by the first group of a regular expression
+    :param file: file containing the version
+    :param new_version: version to update the file with
+    :param pattern: regular expression, its first group matches the version
+    :return: True if file was changed, else False
+    """
+    with open(file, "r") as input_file:
+        content = input_file.read()
+
+    match = re.search(pattern, content, flags=re.MULTILINE)
+    if not match:
+        return False
+    if not validate(match.group(1)):
+        logger.warning("Failed to validate version, aborting")
+        return False
+    logger.info(f"Replacing version {match.group(1)} with {new_version}")
+    start, end = match.span(1)
+    updated = content[:start] + new_version + content[end:]
+    if updated == content:
+        return False
+    with open(file, "w") as output:
+        output.write(updated)
+    return True
+
+
+def update_toml_version(file, new_version, key):
+    """
+    Patches the version stored under a key of a TOML file, e.g. pyproject.toml
+    :param file: TOML file
+    :param new_version: version to update the file with
+    :param key: dotted path to the version, e.g. project.version or tool.poetry.version
+    :return: True if file was changed, else False
+    """
+    table, _, name = key.rpartition(".")
+    value = rf"^{re.escape(name)}[ \t]*=[ \t]*[\"']([^\"'\n]*)[\"']"
+    # lines up to the next table header
+    lines = r"(?:(?!^\[)[\s\S])*?"
+    if table:
+        pattern = rf"^\[{re.escape(table)}\][ \t]*$" + lines + value
+    else:
+        pattern = r"\A" + lines + value
+    return update_version_by_pattern(file, new_version, pattern)
+
+
+def update_version_files(repo_directory, new_version, version_files):
+    """
+    Patches files listed in the version files manifest
+    :param repo_directory: repository path
+    :param new_version: version to update to
+    :param version_files: list of paths or dicts with "path" and either
+                          "key" (TOML files) or "pattern" (regular expression)
+    :return: list of changed files
+    """
+    changed = []
+    for entry in version_files:
+        if isinstance(entry, str):
+            entry = {"path": entry}
+        filename = os.path.join(repo_directory, entry["path"])
+        if not os.path.isfile(filename):
+            logger.warning(f"Version file {entry['path']} not found")
+            continue
+        if entry.get("key"):
+            success = update_toml_version(filename, new_version, entry["key"])
+        elif entry.get("pattern"):
+            success = update_version_by_pattern(filename, new_version, entry["pattern"])
+        else:
+            success = update_version_file(filename, new_version)
+        if success:
+            changed.append(entry["path"])
+    return changed
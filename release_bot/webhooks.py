@@ -16,10 +16,162 @@
 """
 This module is backend for WSGI.
 """
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import redis
 from flask import request, jsonify
 from flask.views import View
 
 from release_bot.celerizer import celery_app
+from release_bot.metrics import metrics
+from release_bot.utils import get_redis_instance
+
+logger = logging.getLogger("release-bot")
+
+
+class DeliveryFilter:
+    """
+    Set of X-GitHub-Delivery IDs seen in the last ttl seconds.
+
+    The set lives in Redis, so that all webhook processes share it; while
+    Redis is unreachable, every process falls back to its own set in memory.
+    """
+
+    KEY_PREFIX = "release-bot:delivery:"
+    # how long to use the in-memory set before trying Redis again
+    REDIS_RETRY_INTERVAL = 60
+
+    def __init__(self, ttl=24 * 3600, db=None):
+        """
+        :param ttl: how long a delivery ID is remembered, in seconds
+        :param db: Redis instance, created on first use if None
+        """
+        self.ttl = ttl
+        self.db = db
+        self._redis_retry_at = 0
+        self._seen = OrderedDict()  # delivery ID -> expiration time
+        self._lock = threading.Lock()
+
+    def _redis(self):
+        if time.monotonic() < self._redis_retry_at:
+            return None
+        if self.db is None:
+            self.db = get_redis_instance()
+        return self.db
+
+    def _redis_failed(self, exc):
+        logger.warning(f"Redis unavailable, remembering deliveries in memory: {exc}")
+        self._redis_retry_at = time.monotonic() + self.REDIS_RETRY_INTERVAL
+
+    def is_new(self, delivery_id):
+        """
+        Remember the delivery ID
+        :param delivery_id: value of X-GitHub-Delivery header
+        :return: False if the ID was seen in the last ttl seconds
+        """
+        db = self._redis()
+        if db is not None:
+            try:
+                return bool(
+                    db.set(self.KEY_PREFIX + delivery_id, 1, nx=True, ex=self.ttl)
+                )
+            except redis.RedisError as exc:
+                self._redis_failed(exc)
+
+        now = time.monotonic()
+        with self._lock:
+            # IDs are ordered by expiration as all have the same ttl
+            while self._seen and next(iter(self._seen.values())) <= now:
+                self._seen.popitem(last=False)
+            if delivery_id in self._seen:
+                return False
+            self._seen[delivery_id] = now + self.ttl
+            return True
+
+    def forget(self, delivery_id):
+        """
+        Forget the delivery ID, e.g. when it couldn't be processed,
+        so that its redelivery is accepted
+        """
+        with self._lock:
+            self._seen.pop(delivery_id, None)
+        db = self._redis()
+        if db is not None:
+            try:
+                db.delete(self.KEY_PREFIX + delivery_id)
+            except redis.RedisError as exc:
+                self._redis_failed(exc)
+
+
+delivery_filter = DeliveryFilter()
+
+
+def get_event(webhook_payload):
+    """
+    Guess the event from the payload when X-GitHub-Event header is missing,
+    the same way parse_web_hook_payload tells the events apart
+    """
+    if "issue" in webhook_payload:
+        return "issues"
+    if "pull_request" in webhook_payload:
+        return "pull_request"
+    if "installation" in webhook_payload:
+        return "installation_repositories"
+    return None
+
+
+def slim_payload(event, webhook_payload):
+    """
+    Keep only the fields tasks read from the events they handle
+
+    :param event: value of X-GitHub-Event header
+    :param webhook_payload: json from github webhook
+    :return: slimmed payload or None if the event is not handled
+    """
+    action = webhook_payload.get("action")
+    repository = webhook_payload.get("repository") or {}
+    repository = {
+        "name": repository.get("name"),
+        "full_name": repository.get("full_name"),
+        "owner": {"login": (repository.get("owner") or {}).get("login")},
+    }
+    if event == "issues" and action == "opened":
+        issue = webhook_payload["issue"]
+        return {
+            "action": action,
+            "issue": {
+                "number": issue["number"],
+                "user": {"login": issue["user"]["login"]},
+            },
+            "repository": repository,
+        }
+    if event == "pull_request" and action == "closed":
+        pull_request = webhook_payload["pull_request"]
+        if pull_request.get("merged") is not True:
+            return None
+        return {
+            "action": action,
+            "pull_request": {
+                "number": pull_request["number"],
+                "merged": True,
+                "user": {"login": pull_request["user"]["login"]},
+            },
+            "repository": repository,
+        }
+    if event in ("installation", "installation_repositories") and action in (
+        "added",
+        "removed",
+    ):
+        key = f"repositories_{action}"
+        return {
+            "action": action,
+            "installation": {"id": webhook_payload["installation"]["id"]},
+            key: [{"full_name": repo["full_name"]} for repo in webhook_payload[key]],
+        }
+    return None
 
 
 class GithubWebhooksHandler(View):
@@ -32,11 +184,55 @@ class GithubWebhooksHandler(View):
 
     def dispatch_request(self):
         self.logger.info("New github webhook call from detected")
-        if request.is_json:
+        if not request.is_json:
+            self.logger.error("This webhook doesn't contain JSON")
+            return jsonify(result={"status": 200})
+
+        webhook_payload = request.get_json()
+        event = request.headers.get("X-GitHub-Event") or get_event(webhook_payload)
+        try:
+            payload = slim_payload(event, webhook_payload)
+        except (KeyError, TypeError) as exc:
+            self.logger.error(f"Malformed {event} webhook: {exc!r}")
+            payload = None
+        if payload is None:
+            self.logger.debug(
+                f"Ignoring {event} {webhook_payload.get('action')} webhook"
+            )
+            metrics.inc("webhook_ignored")
+            return jsonify(result={"status": 202}), 202
+
+        delivery_id = request.headers.get("X-GitHub-Delivery")
+        if delivery_id:
+            metrics.inc("webhook_deliveries")
+            if not delivery_filter.is_new(delivery_id):
+                self.logger.info(
+                    f"Delivery {delivery_id} already received, dropping it"
+                )
+                metrics.inc("webhook_duplicates")
+                return jsonify(result={"status": 200, "duplicate": True})
+        try:
             celery_app.send_task(
                 name="task.celery_task.parse_web_hook_payload",
-                kwargs={"webhook_payload": request.get_json()},
+                kwargs={"webhook_payload": payload},
             )
-        else:
-            self.logger.error("This webhook doesn't contain JSON")
+        except Exception:
+            if delivery_id:
+                delivery_filter.forget(delivery_id)
+            raise
+        metrics.inc("webhook_enqueued")
         return jsonify(result={"status": 200})
+
+
+class MetricsHandler(View):
+    """
+    Counters of this process as JSON
+    """
+
+    def dispatch_request(self):
+        counters = metrics.as_dict()
+        deliveries = counters.get("webhook_deliveries", 0)
+        counters["webhook_duplicate_rate"] = (
+            counters.get("webhook_duplicates", 0) / deliveries if deliveries else 0.0
+        )
+        return jsonify(counters)
@@ -127,7 +127,11 @@ class TestBot:
 
     @pytest.fixture()
     def mock_get_latest_version(self):
-        flexmock(self.release_bot.pypi, latest_version=lambda: "0.0.0")
+        flexmock(
+            self.release_bot.pypi,
+            latest_version=lambda: "0.0.0",
+            version_exists=lambda version: False,
+        )
 
     def test_load_release_conf(self):
         """Tests loading release configuration from repository"""
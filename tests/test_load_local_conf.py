@@ -18,7 +18,11 @@ from pathlib import Path
 import pytest
 from flexmock import flexmock
 
-from release_bot.configuration import configuration, Configuration
+from release_bot.configuration import (
+    configuration,
+    Configuration,
+    get_base_configuration,
+)
 
 
 class TestLoadLocalConf:
@@ -95,3 +99,31 @@ class TestLoadLocalConf:
         configuration.configuration = conf_with_gitchangelog
         configuration.load_configuration()
         assert configuration.gitchangelog
+
+    def test_base_configuration(self, sample_conf, tmpdir):
+        """Tests that base configuration is cached until the file changes"""
+        conf_file = tmpdir.join("conf.yaml")
+        conf_file.write(sample_conf.read_text())
+        base = get_base_configuration(str(conf_file))
+        assert base.project is None
+        assert get_base_configuration(str(conf_file)) is base
+
+        conf_file.write(sample_conf.read_text() + "gitchangelog: true\n")
+        conf_file.setmtime(conf_file.mtime() + 10)
+        changed = get_base_configuration(str(conf_file))
+        assert changed is not base
+        assert changed.gitchangelog
+
+    def test_derived_configurations_are_independent(self, sample_conf):
+        """Tests that derived configurations don't change their base"""
+        base = get_base_configuration(sample_conf)
+        first = base.derive(repository_owner="owner", repository_name="first")
+        second = base.derive(repository_owner="owner", repository_name="second")
+        first.clone_strategy["depth"] = 1
+        first.repositories.append("owner/first")
+
+        assert first.clone_url == "https://github.com/owner/first.git"
+        assert second.clone_url == "https://github.com/owner/second.git"
+        assert base.repository_name == "random_repo"
+        assert base.clone_strategy == second.clone_strategy == {}
+        assert base.repositories == second.repositories == []
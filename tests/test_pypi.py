@@ -16,7 +16,10 @@
 import os
 import re
 import shutil
+import socket
 import subprocess
+import sys
+import time
 from glob import glob
 from pathlib import Path
 
@@ -66,7 +69,8 @@ class TestPypi:
         return shell
 
     @pytest.fixture
-    def pypi(self, tmpdir):
+    def pypi(self, tmpdir, tmp_path_factory, monkeypatch):
+        monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path_factory.mktemp("cache")))
         conf = Configuration()
         path = str(tmpdir)
         src = Path(__file__).parent / "src/rlsbot_test"
@@ -86,44 +90,181 @@ class TestPypi:
         path = Path(str(tmpdir)) / "fooo"
         return str(path)
 
-    def test_missing_setup_sdist(self, non_existent_path, pypi):
+    def test_missing_setup(self, non_existent_path, pypi):
         with pytest.raises(ReleaseException):
-            pypi.build_sdist(non_existent_path)
-
-    def test_missing_setup_wheel(self, non_existent_path, pypi):
-        with pytest.raises(ReleaseException):
-            pypi.build_wheel(non_existent_path)
+            pypi.build(non_existent_path)
 
     def test_missing_project_wrapper(self, pypi):
         pypi.git.repo_path = "nope"
         with pytest.raises(ReleaseException):
             pypi.release()
 
-    def test_sdist(self, pypi):
-        repo_path = pypi.git.repo_path
-        pypi.build_sdist(repo_path)
-        assert os.path.isfile(os.path.join(repo_path, "dist/rlsbot-test-1.0.0.tar.gz"))
-
-    def test_wheel(self, pypi):
-        repo_path = pypi.git.repo_path
-        pypi.build_wheel(repo_path)
-        assert glob(os.path.join(repo_path, "dist/rlsbot_test-1.0.0-py3*.whl"))
-
     def test_install(self, pypi):
         repo_path = pypi.git.repo_path
-        pypi.build_sdist(repo_path)
-        pypi.build_wheel(repo_path)
+        pypi.build(repo_path)
         whl = glob(os.path.join(repo_path, "dist/rlsbot_test-1.0.0-py3*.whl"))[0]
         assert self.run_cmd(f"pip3 install --user {whl}", repo_path).returncode == 0
         assert self.run_cmd("pip3 show rlsbot-test", repo_path).returncode == 0
         assert self.run_cmd("$HOME/.local/bin/rlsbot-test", repo_path).returncode == 0
 
+    def test_build_reused_for_same_tree(self, pypi):
+        repo_path = pypi.git.repo_path
+        dist = pypi.build(repo_path)
+        assert sorted(os.path.basename(path) for path in dist) == [
+            "rlsbot_test-1.0.0-py3-none-any.whl",
+            "rlsbot_test-1.0.0.tar.gz",
+        ]
+        shutil.rmtree(os.path.join(repo_path, "dist"))
+        flexmock(pypi).should_receive("build_artifacts").never()
+        assert pypi.build(repo_path) == dist
+        assert all(os.path.isfile(path) for path in dist)
+
+    def test_build_cache_key_with_version_from_git(self, pypi):
+        repo_path = pypi.git.repo_path
+        tree = pypi.git.get_tree_hash()
+        assert pypi.get_build_key(repo_path) == tree
+
+        with open(os.path.join(repo_path, "setup.py"), "a") as setup:
+            setup.write("# setup(use_scm_version=True)\n")
+        untagged = pypi.get_build_key(repo_path)
+        self.run_cmd("git tag 1.0.0", repo_path)
+        tagged = pypi.get_build_key(repo_path)
+        assert untagged.startswith(tree) and tagged.startswith(tree)
+        assert untagged != tagged
+
+    def test_prebuild_reused_by_release(self, pypi):
+        repo_path = pypi.git.repo_path
+        set_git_credentials(repo_path, "Release Bot", "bot@example.com")
+        self.run_cmd("git checkout -b 1.0.0-release", repo_path)
+        self.run_cmd("git commit --allow-empty -m '1.0.0 release'", repo_path)
+        assert pypi.prebuild()
+        assert not os.path.exists(os.path.join(repo_path, "dist"))
+
+        # the merged tree is the same
+        self.run_cmd("git checkout -q -", repo_path)
+        self.run_cmd("git merge -q --ff-only 1.0.0-release", repo_path)
+        flexmock(pypi).should_receive("build_artifacts").never()
+        pypi.release()
+        assert glob(os.path.join(repo_path, "dist/rlsbot_test-1.0.0-py3*.whl"))
+
+    def test_prebuild_not_reused_for_other_tree(self, pypi):
+        repo_path = pypi.git.repo_path
+        set_git_credentials(repo_path, "Release Bot", "bot@example.com")
+        self.run_cmd("git checkout -b 1.0.0-release", repo_path)
+        with open(os.path.join(repo_path, "README"), "w") as readme:
+            readme.write("release")
+        self.run_cmd("git add README && git commit -m '1.0.0 release'", repo_path)
+        assert pypi.prebuild()
+
+        self.run_cmd("git checkout -q -", repo_path)
+        flexmock(pypi).should_call("build_artifacts").once()
+        pypi.release()
+
     def test_full_release(self, pypi):
         repo_path = pypi.git.repo_path
         pypi.release()
-        assert os.path.isfile(os.path.join(repo_path, "dist/rlsbot-test-1.0.0.tar.gz"))
+        # recent setuptools normalize the sdist name (PEP 625)
+        assert glob(os.path.join(repo_path, "dist/rlsbot[-_]test-1.0.0.tar.gz"))
         whl = glob(os.path.join(repo_path, "dist/rlsbot_test-1.0.0-py3*.whl"))[0]
         assert whl
         assert self.run_cmd(f"pip3 install --user {whl}", repo_path).returncode == 0
         assert self.run_cmd("pip3 show rlsbot-test", repo_path).returncode == 0
         assert self.run_cmd("$HOME/.local/bin/rlsbot-test", repo_path).returncode == 0
+
+
+@pytest.fixture
+def pypiserver(tmpdir):
+    pytest.importorskip("pypiserver")
+    packages = tmpdir.mkdir("packages")
+    with socket.socket() as sock:
+        sock.bind(("localhost", 0))
+        port = sock.getsockname()[1]
+    server = subprocess.Popen(
+        [sys.executable, "-m", "pypiserver", "run", "-p", str(port)]
+        + ["-a", ".", "-P", ".", "--disable-fallback", str(packages)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    url = f"http://localhost:{port}/"
+    for _ in range(100):
+        try:
+            socket.create_connection(("localhost", port)).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    yield url, packages
+    server.terminate()
+    server.wait()
+
+
+def test_upload_skips_existing_files(tmpdir, pypiserver, monkeypatch):
+    url, packages = pypiserver
+    monkeypatch.setenv("TWINE_USERNAME", "bot")
+    monkeypatch.setenv("TWINE_PASSWORD", "bot")
+    project = tmpdir.mkdir("project")
+    src = Path(__file__).parent / "src/rlsbot_test"
+    shutil.copy2(str(src / "setup.py"), str(project))
+    shutil.copy2(str(src / "rlsbot_test.py"), str(project))
+    conf = Configuration()
+    conf.pypi_repository_url = url
+    conf.pypi_index_url = f"{url}simple/"
+    conf.state_db = str(tmpdir / "state.db")
+    pypi = PyPi(conf, flexmock(get_tree_hash=lambda: None))
+    dist = pypi.build(str(project))
+    sdist = [path for path in dist if path.endswith(".tar.gz")][0]
+    wheel = [path for path in dist if path.endswith(".whl")][0]
+    # uploaded by a previous attempt
+    shutil.copy2(sdist, str(packages))
+
+    pypi.upload(str(project))
+    assert sorted(os.listdir(str(packages))) == [
+        os.path.basename(wheel),
+        os.path.basename(sdist),
+    ]
+    status = pypi.state.get_upload_status(pypi.repository, "1.0.0")
+    assert status == {os.path.basename(wheel): "uploaded"}
+
+    # nothing left to upload
+    flexmock(PyPi).should_receive("upload_file").never()
+    pypi.upload(str(project))
+
+
+def test_index_follows_upload_repository():
+    conf = Configuration()
+    pypi = PyPi(conf, flexmock())
+    assert (
+        pypi.get_index_url("https://upload.pypi.org/legacy/")
+        == "https://pypi.org/simple/"
+    )
+    assert (
+        pypi.get_index_url("https://test.pypi.org/legacy")
+        == "https://test.pypi.org/simple/"
+    )
+    assert pypi.get_index_url("https://pypi.example.com/upload/") is None
+    conf.pypi_index_url = "https://pypi.example.com/simple/"
+    assert (
+        pypi.get_index_url("https://pypi.example.com/upload/")
+        == "https://pypi.example.com/simple/"
+    )
+
+
+def test_upload_to_unknown_index(tmpdir, pypiserver, monkeypatch):
+    url, packages = pypiserver
+    monkeypatch.setenv("TWINE_USERNAME", "bot")
+    monkeypatch.setenv("TWINE_PASSWORD", "bot")
+    project = tmpdir.mkdir("project")
+    src = Path(__file__).parent / "src/rlsbot_test"
+    shutil.copy2(str(src / "setup.py"), str(project))
+    shutil.copy2(str(src / "rlsbot_test.py"), str(project))
+    conf = Configuration()
+    conf.pypi_repository_url = url
+    conf.state_db = str(tmpdir / "state.db")
+    pypi = PyPi(conf, flexmock(get_tree_hash=lambda: None))
+    dist = pypi.build(str(project))
+
+    # PyPI is not asked about files of another repository
+    flexmock(PyPi).should_receive("get_index_files").never()
+    pypi.upload(str(project))
+    assert sorted(os.listdir(str(packages))) == sorted(
+        os.path.basename(path) for path in dist
+    )
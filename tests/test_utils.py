@@ -14,9 +14,20 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """Tests utility functions"""
 
+import subprocess
+
 from semantic_version import Version
 
-from release_bot.utils import process_version_from_title, look_for_version_files
+from release_bot.utils import (
+    REDIS_TIMEOUT,
+    get_redis_instance,
+    insert_in_changelog,
+    process_version_from_title,
+    look_for_version_files,
+    VERSION_PREFILTER_SIZE,
+    update_toml_version,
+    update_version_files,
+)
 
 
 def test_process_version_from_title():
@@ -68,3 +79,111 @@ def test_look_for_version_files(tmpdir):
         "__init__.py",
         "version.py",
     }
+
+
+def test_version_deep_in_large_file(tmpdir):
+    """Test that the version is found beyond the prefiltered beginning of a file"""
+    (tmpdir / "setup.py").write_text(
+        "#\n" * VERSION_PREFILTER_SIZE + 'version="1.2.0"\n', "utf-8"
+    )
+    assert look_for_version_files(str(tmpdir), "1.2.3") == ["setup.py"]
+
+
+def test_look_for_version_files_in_git_repo(tmpdir):
+    """Test that only tracked, included and not excluded files are searched"""
+    repo = tmpdir / "repo"
+    for path in (
+        "package/__init__.py",
+        "package/sub/__init__.py",
+        "node_modules/dep/version.py",
+        "docs/version.py",
+        "untracked/version.py",
+    ):
+        file = repo.join(path)
+        file.dirpath().ensure(dir=True)
+        file.write_text('__version__ = "1.2.0"\n', "utf-8")
+    repo.join("package/empty/__init__.py").write_text("", "utf-8", ensure=True)
+    subprocess.run(["git", "init", "-q", str(repo)], check=True)
+    subprocess.run(["git", "add", "package", "node_modules", "docs"], cwd=str(repo))
+
+    assert set(look_for_version_files(str(repo), "1.2.3")) == {
+        "package/__init__.py",
+        "package/sub/__init__.py",
+        "docs/version.py",
+    }
+    assert look_for_version_files(
+        str(repo), "1.2.4", include=["package/*"], exclude=["package/sub/*"]
+    ) == ["package/__init__.py"]
+
+
+def test_look_for_version_files_not_checked_out(tmpdir):
+    """Test that tracked files missing in the working tree are skipped"""
+    repo = tmpdir / "repo"
+    for path in ("a/__init__.py", "b/__init__.py"):
+        repo.join(path).write_text('__version__ = "1.2.0"\n', "utf-8", ensure=True)
+    subprocess.run(["git", "init", "-q", str(repo)], check=True)
+    subprocess.run(["git", "add", "a", "b"], cwd=str(repo), check=True)
+    repo.join("b/__init__.py").remove()
+
+    assert look_for_version_files(str(repo), "1.2.3") == ["a/__init__.py"]
+
+
+def test_update_toml_version(tmpdir):
+    """Test that only the version under the given key is updated"""
+    pyproject = tmpdir / "pyproject.toml"
+    pyproject.write_text(
+        'version = "0.0.1"\n\n[project]\nname = "pkg"\nversion = "1.2.0"\n\n'
+        '[tool.poetry]\nversion = "1.2.0"\n',
+        "utf-8",
+    )
+    assert update_toml_version(str(pyproject), "1.2.3", "tool.poetry.version")
+    assert update_toml_version(str(pyproject), "1.3.0", "project.version")
+    assert not update_toml_version(str(pyproject), "1.3.0", "project.version")
+    assert not update_toml_version(str(pyproject), "1.3.0", "missing.version")
+    assert pyproject.read_text("utf-8") == (
+        'version = "0.0.1"\n\n[project]\nname = "pkg"\nversion = "1.3.0"\n\n'
+        '[tool.poetry]\nversion = "1.2.3"\n'
+    )
+
+
+def test_update_version_files(tmpdir):
+    """Test updating files from the version files manifest"""
+    tmpdir.join("pkg/__init__.py").write_text(
+        '__version__ = "1.2.0"\n', "utf-8", ensure=True
+    )
+    tmpdir.join("pyproject.toml").write_text('[project]\nversion = "1.2.0"\n', "utf-8")
+    tmpdir.join("docs/conf.py").write_text("release = '1.2.0'\n", "utf-8", ensure=True)
+    manifest = [
+        "pkg/__init__.py",
+        {"path": "pyproject.toml", "key": "project.version"},
+        {"path": "docs/conf.py", "pattern": "^release = '(.*)'"},
+        "missing.py",
+    ]
+    assert update_version_files(str(tmpdir), "1.2.3", manifest) == [
+        "pkg/__init__.py",
+        "pyproject.toml",
+        "docs/conf.py",
+    ]
+    assert (
+        tmpdir.join("pkg/__init__.py").read_text("utf-8") == "__version__ = '1.2.3'\n"
+    )
+    assert tmpdir.join("docs/conf.py").read_text("utf-8") == "release = '1.2.3'\n"
+
+
+def test_insert_in_changelog(tmpdir):
+    """Test that the new section is prepended and the file mode is kept"""
+    changelog = tmpdir / "CHANGELOG.md"
+    changelog.write_text("# 0.0.1\n\n* first\n", "utf-8")
+    changelog.chmod(0o640)
+    assert insert_in_changelog(str(changelog), "0.0.2", "* second")
+    assert changelog.read_text("utf-8") == "# 0.0.2\n\n* second\n# 0.0.1\n\n* first\n"
+    assert changelog.stat().mode & 0o777 == 0o640
+    assert tmpdir.listdir() == [changelog]
+    assert not insert_in_changelog(str(tmpdir / "missing.md"), "0.0.2", "* second")
+
+
+def test_redis_timeouts():
+    """Test that an unreachable Redis doesn't block callers for long"""
+    options = get_redis_instance().connection_pool.connection_kwargs
+    assert options["socket_connect_timeout"] == REDIS_TIMEOUT
+    assert options["socket_timeout"] == REDIS_TIMEOUT
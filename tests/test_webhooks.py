@@ -17,9 +17,14 @@ import pytest
 from flask import Flask
 from flexmock import flexmock
 import json
+import time
 
-from release_bot.webhooks import GithubWebhooksHandler
+import redis
+
+from release_bot import webhooks
+from release_bot.webhooks import DeliveryFilter, GithubWebhooksHandler, MetricsHandler
 from release_bot.celerizer import celery_app
+from release_bot.metrics import metrics
 
 
 @pytest.fixture()
@@ -50,10 +55,33 @@ def flask_instance():
         ],
     )
 
+    app.add_url_rule("/metrics", view_func=MetricsHandler.as_view("metrics"))
+
     test_client = app.test_client()
     return test_client
 
 
+class FakeRedis:
+    def __init__(self):
+        self.keys = {}
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.keys:
+            return None
+        self.keys[key] = value
+        return True
+
+    def delete(self, key):
+        self.keys.pop(key, None)
+
+
+class BrokenRedis:
+    def set(self, *args, **kwargs):
+        raise redis.ConnectionError("Connection refused")
+
+    delete = set
+
+
 def test_bad_requests(flask_instance):
     """Test GET method request on different routes"""
     response = flask_instance.get("/")
@@ -62,17 +90,171 @@ def test_bad_requests(flask_instance):
     assert response.status_code == 405
 
 
+ISSUE_OPENED = {
+    "action": "opened",
+    "issue": {
+        "number": 1,
+        "title": "0.0.2 release",
+        "body": "a long description",
+        "user": {"login": "reporter", "id": 42},
+    },
+    "repository": {
+        "name": "repo-name",
+        "full_name": "repo-owner/repo-name",
+        "owner": {"login": "repo-owner", "id": 7},
+        "description": "a repository",
+    },
+    "sender": {"login": "reporter"},
+}
+
+
 def test_json_requests(flask_instance):
-    """Test if POST method which contains JSON call correct methods"""
-    flexmock(celery_app).should_receive("send_task").and_return("vooosh!").once()
+    """Test that events which tasks don't handle are not enqueued"""
+    flexmock(celery_app).should_receive("send_task").never()
 
     json_dummy_dict = {
         "dummy": "dummy",
     }
-    # will not call handle_issue or handle_pr within GithubWebhooksHandler instance
     response = flask_instance.post(
         "/webhook-handler/",
         data=json.dumps(json_dummy_dict),
         content_type="application/json",
     )
+    assert response.status_code == 202
+    response = flask_instance.post(
+        "/webhook-handler/",
+        data=json.dumps(dict(ISSUE_OPENED, action="closed")),
+        content_type="application/json",
+        headers={"X-GitHub-Event": "issues"},
+    )
+    assert response.status_code == 202
+    response = flask_instance.post(
+        "/webhook-handler/",
+        data=json.dumps(ISSUE_OPENED),
+        content_type="application/json",
+        headers={"X-GitHub-Event": "issue_comment"},
+    )
+    assert response.status_code == 202
+
+
+def test_slimmed_payload(flask_instance):
+    """Test that only fields read by tasks are enqueued"""
+    flexmock(celery_app).should_receive("send_task").with_args(
+        name="task.celery_task.parse_web_hook_payload",
+        kwargs={
+            "webhook_payload": {
+                "action": "opened",
+                "issue": {"number": 1, "user": {"login": "reporter"}},
+                "repository": {
+                    "name": "repo-name",
+                    "full_name": "repo-owner/repo-name",
+                    "owner": {"login": "repo-owner"},
+                },
+            }
+        },
+    ).once()
+    response = flask_instance.post(
+        "/webhook-handler/",
+        data=json.dumps(ISSUE_OPENED),
+        content_type="application/json",
+        headers={"X-GitHub-Event": "issues"},
+    )
     assert response.status_code == 200
+
+
+@pytest.mark.parametrize(
+    "event, payload, expected",
+    [
+        (
+            "pull_request",
+            {
+                "action": "closed",
+                "pull_request": {"number": 2, "merged": False, "user": {"login": "a"}},
+            },
+            None,
+        ),
+        (
+            "pull_request",
+            {
+                "action": "closed",
+                "pull_request": {"number": 2, "merged": True, "user": {"login": "a"}},
+                "repository": {
+                    "name": "r",
+                    "full_name": "o/r",
+                    "owner": {"login": "o"},
+                },
+            },
+            {
+                "action": "closed",
+                "pull_request": {"number": 2, "merged": True, "user": {"login": "a"}},
+                "repository": {
+                    "name": "r",
+                    "full_name": "o/r",
+                    "owner": {"login": "o"},
+                },
+            },
+        ),
+        (
+            "installation_repositories",
+            {
+                "action": "removed",
+                "installation": {"id": 3, "account": {}},
+                "repositories_removed": [{"id": 1, "full_name": "o/r"}],
+            },
+            {
+                "action": "removed",
+                "installation": {"id": 3},
+                "repositories_removed": [{"full_name": "o/r"}],
+            },
+        ),
+        ("push", {"ref": "refs/heads/master"}, None),
+    ],
+)
+def test_slim_payload(event, payload, expected):
+    assert webhooks.slim_payload(event, payload) == expected
+    assert webhooks.slim_payload(webhooks.get_event(payload), payload) == expected
+
+
+@pytest.mark.parametrize("db", [FakeRedis(), BrokenRedis()])
+def test_duplicate_deliveries(flask_instance, monkeypatch, db):
+    """Test that redeliveries of the same webhook are not enqueued again"""
+    monkeypatch.setattr(webhooks, "delivery_filter", DeliveryFilter(db=db))
+    flexmock(celery_app).should_receive("send_task").and_return("vooosh!").twice()
+    duplicates = metrics.get("webhook_duplicates")
+
+    for delivery in ("1", "2", "1"):
+        response = flask_instance.post(
+            "/webhook-handler/",
+            data=json.dumps(ISSUE_OPENED),
+            content_type="application/json",
+            headers={"X-GitHub-Delivery": delivery},
+        )
+        assert response.status_code == 200
+    assert metrics.get("webhook_duplicates") == duplicates + 1
+    assert 0 < flask_instance.get("/metrics").get_json()["webhook_duplicate_rate"] <= 1
+
+
+def test_delivery_forgotten_when_not_enqueued(flask_instance, monkeypatch):
+    monkeypatch.setattr(webhooks, "delivery_filter", DeliveryFilter(db=FakeRedis()))
+    flexmock(celery_app).should_receive("send_task").and_raise(
+        ConnectionError
+    ).and_return("vooosh!").twice()
+    for _ in range(2):
+        try:
+            flask_instance.post(
+                "/webhook-handler/",
+                data=json.dumps(ISSUE_OPENED),
+                content_type="application/json",
+                headers={"X-GitHub-Delivery": "1"},
+            )
+        except ConnectionError:
+            pass
+    assert not webhooks.delivery_filter.is_new("1")
+
+
+def test_delivery_filter_expiration():
+    delivery_filter = DeliveryFilter(ttl=0.1, db=BrokenRedis())
+    assert delivery_filter.is_new("1")
+    assert not delivery_filter.is_new("1")
+    time.sleep(0.15)
+    assert delivery_filter.is_new("1")
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+from pathlib import Path
+
+import pytest
+from celery.exceptions import Retry
+from flexmock import flexmock
+
+from release_bot import celery_task
+from release_bot.configuration import configuration
+
+
+class FakeRedis:
+    """Redis with the commands used to coalesce events"""
+
+    def __init__(self):
+        self.data = {}
+        self.locks = {}
+
+    def rpush(self, key, value):
+        self.data.setdefault(key, []).append(value)
+
+    def lrange(self, key, start, end):
+        return list(self.data.get(key, []))
+
+    def expire(self, key, seconds):
+        return key in self.data
+
+    def set(self, key, value, nx=False, ex=None):
+        if nx and key in self.data:
+            return None
+        self.data[key] = value
+        return True
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def delete(self, key):
+        return int(self.data.pop(key, None) is not None)
+
+    def ltrim(self, key, start, end):
+        self.data[key] = self.data.get(key, [])[start:]
+        if not self.data[key]:
+            del self.data[key]  # Redis removes empty lists
+
+    def lock(self, name, timeout=None):
+        return self.locks.setdefault(name, FakeLock(name))
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+
+class FakeLock:
+    def __init__(self, name):
+        self.name = name
+        self.extended = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, blocking=True):
+        return self._lock.acquire(blocking)
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    def reacquire(self):
+        self.extended += 1
+
+
+class FakePipeline:
+    def __init__(self, db):
+        self.db = db
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+    def execute(self):
+        return [getattr(self.db, name)(*a, **kw) for name, a, kw in self.commands]
+
+
+def issue_opened(number, full_name="owner/repo"):
+    owner, name = full_name.split("/")
+    return {
+        "action": "opened",
+        "issue": {"number": number, "user": {"login": "reporter"}},
+        "repository": {"name": name, "full_name": full_name, "owner": {"login": owner}},
+    }
+
+
+def pr_merged(number, full_name="owner/repo"):
+    event = issue_opened(number, full_name)
+    del event["issue"]
+    event.update(
+        action="closed",
+        pull_request={"number": number, "merged": True, "user": {"login": "author"}},
+    )
+    return event
+
+
+@pytest.fixture()
+def db():
+    db = FakeRedis()
+    flexmock(celery_task).should_receive("get_redis_instance").and_return(db)
+    return db
+
+
+def test_burst_schedules_one_task_per_repository(db):
+    flexmock(celery_task.reconcile_repository).should_receive("apply_async").with_args(
+        args=("owner/repo",), countdown=celery_task.COALESCE_WINDOW
+    ).once()
+    flexmock(celery_task.reconcile_repository).should_receive("apply_async").with_args(
+        args=("owner/other",), countdown=celery_task.COALESCE_WINDOW
+    ).once()
+
+    celery_task.parse_web_hook_payload(pr_merged(1))
+    celery_task.parse_web_hook_payload(issue_opened(2))
+    celery_task.parse_web_hook_payload(issue_opened(2))
+    celery_task.parse_web_hook_payload(issue_opened(3, "owner/other"))
+
+    assert len(db.data[celery_task.PENDING_PREFIX + "owner/repo"]) == 3
+    assert len(db.data[celery_task.PENDING_PREFIX + "owner/other"]) == 1
+
+
+def test_reconcile_handles_pending_events_together(db):
+    flexmock(celery_task.reconcile_repository).should_receive("apply_async").once()
+    events = [pr_merged(1), issue_opened(2), issue_opened(2)]
+    for event in events:
+        celery_task.parse_web_hook_payload(event)
+
+    flexmock(celery_task).should_receive("handle_events").with_args(events, db).once()
+    celery_task.reconcile_repository("owner/repo")
+
+    assert celery_task.PENDING_PREFIX + "owner/repo" not in db.data
+    assert celery_task.SCHEDULED_PREFIX + "owner/repo" not in db.data
+    assert not db.locks[celery_task.LOCK_PREFIX + "owner/repo"].locked()
+
+    # the next event schedules a new task
+    flexmock(celery_task.reconcile_repository).should_receive("apply_async").once()
+    celery_task.parse_web_hook_payload(issue_opened(4))
+
+
+def test_events_kept_when_handling_fails(db):
+    flexmock(celery_task.reconcile_repository).should_receive("apply_async")
+    celery_task.parse_web_hook_payload(pr_merged(1))
+
+    def fail(events, db):
+        # queued while the first one is being handled
+        celery_task.parse_web_hook_payload(issue_opened(2))
+        raise RuntimeError("no space left on device")
+
+    flexmock(celery_task).should_receive("handle_events").replace_with(fail).once()
+    with pytest.raises(RuntimeError):
+        celery_task.reconcile_repository("owner/repo")
+    assert not db.locks[celery_task.LOCK_PREFIX + "owner/repo"].locked()
+
+    # the retry handles both, the second one stays if it is queued meanwhile
+    def handle(events, db):
+        assert events == [pr_merged(1), issue_opened(2)]
+        celery_task.parse_web_hook_payload(issue_opened(3))
+
+    flexmock(celery_task).should_receive("handle_events").replace_with(handle).once()
+    celery_task.reconcile_repository("owner/repo")
+    assert celery_task.get_pending_events("owner/repo", db) == [issue_opened(3)]
+
+
+def test_failures_retried_with_backoff(db):
+    flexmock(celery_task.reconcile_repository).should_receive("apply_async")
+    celery_task.parse_web_hook_payload(pr_merged(1))
+    flexmock(celery_task).should_receive("handle_events").and_raise(
+        RuntimeError("broken release-conf")
+    )
+    retries = []
+
+    def retry(**kwargs):
+        retries.append(kwargs)
+        return Retry()
+
+    flexmock(celery_task.reconcile_repository).should_receive("retry").replace_with(
+        retry
+    )
+    with pytest.raises(Retry):
+        celery_task.reconcile_repository("owner/repo", failures=2)
+    assert retries[0]["kwargs"] == {"failures": 3}
+    assert retries[0]["countdown"] == celery_task.LOCK_RETRY_DELAY * 4
+
+    # the last failure gives up, events stay pending
+    with pytest.raises(RuntimeError):
+        celery_task.reconcile_repository(
+            "owner/repo", failures=celery_task.MAX_FAILURE_RETRIES
+        )
+    assert len(retries) == 1
+    assert celery_task.get_pending_events("owner/repo", db) == [pr_merged(1)]
+
+
+def test_lock_extended_while_handling(db, monkeypatch):
+    monkeypatch.setattr(celery_task, "LOCK_TIMEOUT", 0.03)
+    lock = db.lock(celery_task.LOCK_PREFIX + "owner/repo")
+    with celery_task.keep_lock(lock):
+        time.sleep(0.1)
+    extended = lock.extended
+    assert extended >= 2
+    time.sleep(0.05)
+    assert lock.extended == extended
+
+
+def test_reconcile_retried_while_repository_is_locked(db):
+    db.lock(celery_task.LOCK_PREFIX + "owner/repo").acquire()
+    flexmock(celery_task).should_receive("handle_events").never()
+    with pytest.raises(Retry):
+        celery_task.reconcile_repository("owner/repo")
+
+    # other repositories are not blocked
+    flexmock(celery_task.reconcile_repository).should_receive("apply_async").once()
+    celery_task.parse_web_hook_payload(issue_opened(1, "owner/other"))
+    flexmock(celery_task).should_receive("handle_events").once()
+    celery_task.reconcile_repository("owner/other")
+
+
+def make_bot(github_username):
+    release_bot = flexmock(
+        state=flexmock(is_processed=lambda repository, kind, number: number == 3),
+        repository="owner/repo",
+        project=flexmock(default_branch="master"),
+        git=flexmock(pull_branch=lambda branch: None),
+        load_release_conf=lambda: None,
+        conf=flexmock(github_username=github_username),
+    )
+    release_bot.should_receive("cleanup").once()
+    return release_bot
+
+
+def test_handle_events_one_bot_per_author(db):
+    pr_bot, issue_bot = make_bot("author"), make_bot("reporter")
+    flexmock(celery_task).should_receive("set_configuration").with_args(
+        pr_merged(1), db=db, issue=False
+    ).and_return(pr_bot, flexmock()).once()
+    flexmock(celery_task).should_receive("set_configuration").with_args(
+        issue_opened(4), db=db, issue=True
+    ).and_return(issue_bot, flexmock()).once()
+    flexmock(celery_task).should_receive("handle_pr").with_args(pr_bot, [1, 5]).once()
+    flexmock(celery_task).should_receive("handle_issue").with_args(issue_bot).once()
+
+    celery_task.handle_events(
+        [
+            pr_merged(5),
+            pr_merged(1),
+            pr_merged(3),
+            issue_opened(2),
+            pr_merged(1),
+            issue_opened(4),
+        ],
+        db,
+    )
+    assert pr_bot.conf.github_username == "author"
+    assert issue_bot.conf.github_username == "reporter"
+
+
+def test_set_configuration_per_task(db, monkeypatch):
+    conf_path = Path(__file__).parent.parent / "src/sample_conf.yaml"
+    monkeypatch.setenv("CONF_PATH", str(conf_path))
+    flexmock(celery_task).should_receive("ReleaseBot").replace_with(lambda conf: conf)
+    repository_name = configuration.repository_name
+
+    first, _ = celery_task.set_configuration(issue_opened(1, "owner/first"), db)
+    second, _ = celery_task.set_configuration(pr_merged(2, "owner/second"), db, False)
+
+    assert (first.repository_name, first.github_username) == ("first", "reporter")
+    assert (second.repository_name, second.github_username) == ("second", "author")
+    assert second.clone_url == "https://github.com/owner/second.git"
+    assert configuration.repository_name == repository_name
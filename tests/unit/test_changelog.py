@@ -0,0 +1,141 @@
+"""
+Unit tests for changelog module
+"""
+
+import shutil
+import subprocess
+
+import pytest
+from flexmock import flexmock
+
+from release_bot.changelog import (
+    ChangelogCache,
+    ChangelogEngine,
+    ChangelogIndex,
+    ChangelogIndexCache,
+    get_engine_template,
+)
+from release_bot.configuration import configuration
+from release_bot.git import Git
+from release_bot.init_repo import GITCHANGELOG_RC_STRING, TEMPLATE_STRING
+from release_bot.utils import parse_changelog
+
+CHANGELOG = (
+    b"# 0.0.20\n* Twenty\n"
+    b"# 0.0.2\n* New entry\n* Fixes\n"
+    b"# 0.0.1\n* Test entry\n# in a section\n"
+    b"# v0.0.1-rc1\n* First\n"
+)
+
+
+def test_sections():
+    index = ChangelogIndex(CHANGELOG)
+    assert index.versions == ["0.0.20", "0.0.2", "0.0.1", "v0.0.1-rc1"]
+    assert index.section("0.0.20") == parse_changelog("0.0.20", CHANGELOG.decode())
+    assert index.section("0.0.2") == "# 0.0.2\n* New entry\n* Fixes"
+    assert index.section("0.0.1") == "# 0.0.1\n* Test entry\n# in a section"
+    assert index.section("v0.0.1-rc1") == "# v0.0.1-rc1\n* First\n"
+    assert index.section("0.0.3") is None
+    assert ChangelogIndex(b"").versions == []
+    assert ChangelogIndex(b"# 0.0.1\n").section("0.0.1") == "# 0.0.1\n"
+
+
+def test_cache_by_blob_sha(tmpdir):
+    upstream = str(tmpdir)
+    for cmd in (
+        "git init -q -b master .",
+        "git config user.name bot",
+        "git config user.email bot@example.com",
+    ):
+        subprocess.run(cmd.split(), cwd=upstream, check=True)
+    (tmpdir / "CHANGELOG.md").write_binary(CHANGELOG)
+    subprocess.run("git add CHANGELOG.md".split(), cwd=upstream, check=True)
+    subprocess.run(["git", "commit", "-qm", "changelog"], cwd=upstream, check=True)
+    subprocess.run(["git", "commit", "-qm", "empty", "--allow-empty"], cwd=upstream)
+    git = Git(upstream, configuration)
+    cache = ChangelogIndexCache(size=1)
+
+    index = cache.get(git, "HEAD")
+    assert index.section("0.0.2") == "# 0.0.2\n* New entry\n* Fixes"
+    flexmock(git).should_receive("read_blob").never()
+    assert cache.get(git, "HEAD~1") is index
+    assert cache.get(git, "HEAD", "missing.md") is None
+    git.cleanup()
+
+
+@pytest.fixture
+def repository(tmpdir):
+    path = str(tmpdir)
+    for cmd in (
+        "git init -q -b master .",
+        "git config user.name bot",
+        "git config user.email bot@example.com",
+        "git commit -q --allow-empty -m initial",
+        "git tag 0.0.1",
+    ):
+        subprocess.run(cmd.split(), cwd=path, check=True)
+    for message in (
+        "new: usr: add an option",
+        "fix: a crash\n\nIt crashed.\n\nSigned-off-by: bot <bot@example.com>",
+        "Update docs",
+        "chg: dev: tidy up @refactor",
+        "fix: pkg: bump",
+    ):
+        subprocess.run(
+            ["git", "commit", "-q", "--allow-empty", "-m", message],
+            cwd=path,
+            check=True,
+        )
+    return path
+
+
+def test_engine(repository):
+    changelog = ChangelogEngine(repository).render("0.0.1")
+    assert changelog == (
+        "\n### New\n\n* Add an option. [bot]\n\n"
+        "### Fix\n\n* A crash. [bot]\n\n  It crashed.\n\n"
+        "### Other\n\n* Update docs. [bot]\n\n\n"
+    )
+    assert ChangelogEngine(repository).render("HEAD") == ""
+
+
+@pytest.mark.skipif(not shutil.which("gitchangelog"), reason="needs gitchangelog")
+def test_engine_same_as_gitchangelog(repository):
+    with open(f"{repository}/.gitchangelog.rc", "w") as rc_file:
+        rc_file.write(GITCHANGELOG_RC_STRING)
+    with open(f"{repository}/markdown.tpl", "w") as template_file:
+        template_file.write(TEMPLATE_STRING)
+    expected = subprocess.run(
+        ["gitchangelog", "^0.0.1", "HEAD"],
+        cwd=repository,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    ).stdout
+    assert ChangelogEngine(repository).render("0.0.1") == expected
+
+
+def test_engine_template(tmpdir):
+    # gitchangelog's own default output isn't Markdown
+    assert get_engine_template(str(tmpdir)) is None
+    (tmpdir / ".gitchangelog.rc").write_text(GITCHANGELOG_RC_STRING, "utf-8")
+    assert get_engine_template(str(tmpdir)) == TEMPLATE_STRING
+    (tmpdir / "markdown.tpl").write_text("{{#versions}}{{/versions}}", "utf-8")
+    assert get_engine_template(str(tmpdir)) == "{{#versions}}{{/versions}}"
+    (tmpdir / ".gitchangelog.rc").write_text(
+        GITCHANGELOG_RC_STRING + "include_merge = False\n", "utf-8"
+    )
+    assert get_engine_template(str(tmpdir)) is None
+
+
+def test_changelog_cache_eviction(tmpdir):
+    cache = ChangelogCache(str(tmpdir), quota_mb=1)
+    key = cache.range_key("https://example.com/repo", "a" * 40, "git-log")
+    assert key != cache.range_key("https://example.com/repo", "a" * 40, "engine")
+    assert cache.get(key, "b" * 40) is None
+
+    cache.put(key, "b" * 40, {"changelog": "x" * 600 * 1024})
+    assert cache.heads(key) == ["b" * 40]
+    cache.put(key, "c" * 40, {"changelog": "y" * 600 * 1024})
+    assert cache.heads(key) == ["c" * 40]
+    assert cache.get(key, "c" * 40) == {"changelog": "y" * 600 * 1024}
@@ -0,0 +1,64 @@
+"""
+Unit tests for daemon module
+"""
+
+import threading
+import time
+
+from flexmock import flexmock
+
+from release_bot.configuration import Configuration
+from release_bot.daemon import Daemon
+
+
+class FakeBot:
+    lock = threading.Lock()
+    active = 0
+    max_active = 0
+
+    def __init__(self, repository, calls):
+        self.repository = repository
+        self.calls = calls
+
+    def reconcile(self):
+        with self.lock:
+            FakeBot.active += 1
+            FakeBot.max_active = max(FakeBot.max_active, FakeBot.active)
+        time.sleep(0.01)
+        self.calls.append(self.repository)
+        with self.lock:
+            FakeBot.active -= 1
+        if self.repository == "owner/broken":
+            raise RuntimeError("boom")
+
+    def cleanup(self):
+        pass
+
+
+def test_daemon_runs_every_repository_once():
+    conf = Configuration()
+    conf.repositories = [f"owner/repo{i}" for i in range(10)] + ["owner/broken"]
+    conf.concurrency = 3
+    calls = []
+
+    daemon = Daemon(conf)
+    flexmock(daemon).should_receive("get_bot").replace_with(
+        lambda repository: FakeBot(repository, calls)
+    )
+    daemon.run()
+
+    assert sorted(calls) == sorted(conf.repositories)
+    assert FakeBot.max_active <= 3
+
+
+def test_daemon_schedule_order():
+    daemon = Daemon(Configuration())
+    daemon.schedule("owner/late", 10)
+    daemon.schedule("owner/first", 5)
+    daemon.schedule("owner/second", 5)
+
+    assert [item[2] for item in sorted(daemon.queue)] == [
+        "owner/first",
+        "owner/second",
+        "owner/late",
+    ]
@@ -2,13 +2,20 @@
 Unit tests for github module
 """
 
+import os
+import subprocess
+import time
+from datetime import datetime, timezone
+
+import pytest
 from flexmock import flexmock
 from ogr.abstract import GitTag, GitProject
 from ogr.services.github import GithubRelease
 
 from release_bot.configuration import configuration
+from release_bot.exceptions import ReleaseException
 from release_bot.git import Git
-from release_bot.github import Github
+from release_bot.github import Github, GitHubApp, GitHubAppTokens, JWTAuth
 
 
 def test_latest_release():
@@ -47,3 +54,193 @@ def test_latest_release():
     github = Github(c, git)
     obtained_release = github.latest_release()
     assert obtained_release == "0.0.0"
+
+
+def test_latest_release_uses_snapshot():
+    project = flexmock(default_branch="master")
+    project.should_receive("get_releases").and_return(
+        [flexmock(title="0.0.10"), flexmock(title="0.0.9")]
+    ).once()
+
+    c = flexmock(configuration)
+    c.project = project
+    github = Github(c, flexmock(Git))
+
+    # several calls during one cycle hit the forge only once
+    assert github.latest_release() == "0.0.10"
+    assert github.latest_release() == "0.0.10"
+    assert github.snapshot.latest_release.title == "0.0.10"
+
+
+def test_snapshot_refresh():
+    project = flexmock(default_branch="master")
+    project.should_receive("get_branches").and_return(["master"]).and_return(
+        ["master", "0.1.0-release"]
+    ).twice()
+
+    c = flexmock(configuration)
+    c.project = project
+    github = Github(c, flexmock(Git))
+
+    assert not github.branch_exists("0.1.0-release")
+    assert not github.branch_exists("0.1.0-release")
+    github.refresh_snapshot()
+    assert github.branch_exists("0.1.0-release")
+
+
+def test_get_merged_prs_since_stops_at_watermark():
+    def pull(number, updated_at, merged=True):
+        return flexmock(
+            number=number,
+            title=f"0.0.{number} release",
+            user=flexmock(login="author"),
+            updated_at=updated_at,
+            merged_at=updated_at if merged else None,
+        )
+
+    def pulls():
+        yield pull(4, datetime(2020, 1, 4))
+        yield pull(3, datetime(2020, 1, 3), merged=False)
+        yield pull(4, datetime(2020, 1, 4))
+        # updated in the same second as the watermark
+        yield pull(5, datetime(2020, 1, 2))
+        yield pull(1, datetime(2020, 1, 1))
+        raise AssertionError("read past the watermark")
+
+    c = flexmock(configuration)
+    c.project = flexmock(github_repo=flexmock(get_pulls=lambda **_: pulls()))
+    github = Github(c, flexmock(Git))
+
+    merged_prs, watermark = github.get_merged_prs_since(datetime(2020, 1, 2))
+    assert [pr.id for pr in merged_prs] == [4, 5]
+    assert watermark == datetime(2020, 1, 4)
+
+
+def test_get_changelog_from_release_branch(tmpdir):
+    upstream = str(tmpdir)
+    for cmd in (
+        "git init -q -b master .",
+        "git config user.name bot",
+        "git config user.email bot@example.com",
+        "git commit -q --allow-empty -m initial",
+        "git checkout -q -b 0.0.2-release",
+    ):
+        subprocess.run(cmd.split(), cwd=upstream, check=True)
+    (tmpdir / "CHANGELOG.md").write_text("# 0.0.2\n* Fixes\n", "utf-8")
+    subprocess.run("git add CHANGELOG.md".split(), cwd=upstream, check=True)
+    subprocess.run(["git", "commit", "-qm", "release"], cwd=upstream, check=True)
+    subprocess.run("git checkout -q master".split(), cwd=upstream, check=True)
+
+    c = flexmock(configuration)
+    c.project = flexmock(default_branch="master", get_releases=lambda: [])
+    git = Git(upstream, configuration)
+    github = Github(c, git)
+
+    assert github.get_changelog("0.0.2") == "# 0.0.2\n* Fixes\n"
+    assert not os.path.exists(f"{git.repo_path}/CHANGELOG.md")
+    git.cleanup()
+
+
+class FakeApp:
+    """Github app which counts the tokens it created"""
+
+    app_id = 1
+
+    def __init__(self, lifetime=3600):
+        self.lifetime = lifetime
+        self.created = 0
+
+    def create_installation_access_token(self, installation_id):
+        self.created += 1
+        expires_at = datetime.fromtimestamp(time.time() + self.lifetime, timezone.utc)
+        return {
+            "token": f"token-{installation_id}-{self.created}",
+            "expires_at": expires_at.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        }
+
+
+def test_installation_tokens_cached():
+    tokens = GitHubAppTokens()
+    app = FakeApp()
+    assert tokens.get(app, 10) == "token-10-1"
+    assert tokens.get(app, 10) == "token-10-1"
+    assert tokens.get(app, 20) == "token-20-2"
+    assert app.created == 2
+
+    # a token about to expire is not used
+    app = FakeApp(lifetime=GitHubAppTokens.REFRESH_MARGIN - 10)
+    flexmock(GitHubAppTokens).should_receive("_refresh")
+    assert tokens.get(app, 30) == "token-30-1"
+    assert tokens.get(app, 30) == "token-30-2"
+
+
+def test_installation_tokens_refreshed_when_used():
+    tokens = GitHubAppTokens()
+    app = FakeApp()
+    token = tokens.get(app, 10)
+    tokens._refresh(app, 10)
+    assert app.created == 2
+    assert tokens.get(app, 10) != token
+
+    # not used since the last refresh
+    tokens._refresh(app, 10)
+    tokens._refresh(app, 10)
+    assert app.created == 3
+    assert tokens.get(app, 10) == "token-10-3"
+
+
+def test_jwt_reused():
+    auth = JWTAuth(iss=1, key="key")
+    flexmock(auth).should_receive("generate_token").and_return("jwt").once()
+    for _ in range(3):
+        request = flexmock(headers={})
+        assert auth(request).headers["Authorization"] == "bearer jwt"
+
+
+def test_installation_repositories(tmpdir):
+    key = tmpdir.join("key.pem")
+    key.write("key")
+    app = GitHubApp(1, str(key))
+    pages = [
+        flexmock(
+            status_code=200,
+            json=lambda: {"total_count": 3, "repositories": [{"full_name": "o/a"}]},
+        ),
+        flexmock(
+            status_code=200,
+            json=lambda: {
+                "total_count": 3,
+                "repositories": [{"full_name": "o/b"}, {"full_name": "o/c"}],
+            },
+        ),
+    ]
+    flexmock(app.session).should_receive("get").and_return(pages[0]).and_return(
+        pages[1]
+    ).times(2)
+    assert app.get_installation_repositories(10) == ["o/a", "o/b", "o/c"]
+
+    flexmock(app.session).should_receive("get").and_return(
+        flexmock(status_code=401, reason="Unauthorized")
+    )
+    with pytest.raises(ReleaseException):
+        app.get_installation_repositories(10)
+
+
+def test_get_github_file_from_enterprise():
+    project = flexmock(
+        service=flexmock(hostname="ghe.example.com"), namespace="o", repo="r"
+    )
+    c = flexmock(configuration)
+    c.project = project
+    github = Github(c, flexmock(Git))
+    url = "https://ghe.example.com/api/v3/repos/o/r/contents/"
+    flexmock(github.session).should_receive("get").with_args(
+        url + "setup.cfg", params=None, headers=object, timeout=object
+    ).and_return(flexmock(status_code=404))
+    flexmock(github.logger).should_receive("error").never()
+    assert github.get_github_file("setup.cfg") is None
+
+    flexmock(github.session).should_receive("get").with_args(
+        url + "release-conf.yaml", params=None, headers=object, timeout=object
+    ).and_return(flexmock(status_code=200, from_cache=False, text="pypi: true"))
+    assert github.get_github_file("release-conf.yaml") == "pypi: true"
@@ -0,0 +1,67 @@
+"""
+Unit tests for http_cache module
+"""
+
+import requests
+from flexmock import flexmock
+
+from release_bot.http_cache import ConditionalSession
+
+
+def response(status_code, headers=None, text=""):
+    r = requests.Response()
+    r.status_code = status_code
+    r.headers.update(headers or {})
+    r._content = text.encode()
+    return r
+
+
+def mock_server(*responses):
+    """Replace the network with given responses, return list of sent headers"""
+    sent = []
+    responses = list(responses)
+
+    def request(method, url, headers=None, **kwargs):
+        sent.append((method, headers or {}))
+        return responses.pop(0)
+
+    flexmock(requests.Session).should_receive("request").replace_with(request)
+    return sent
+
+
+def test_not_modified_reuses_cached_response():
+    session = ConditionalSession()
+    sent = mock_server(response(200, {"ETag": '"abc"'}, "content"), response(304))
+
+    first = session.get("https://example.com/file")
+    assert first.text == "content"
+    assert not first.from_cache
+
+    second = session.get("https://example.com/file")
+    assert second.text == "content"
+    assert second.from_cache
+    assert sent[1][1]["If-None-Match"] == '"abc"'
+
+
+def test_modified_response_replaces_cache():
+    session = ConditionalSession()
+    mock_server(
+        response(200, {"ETag": '"abc"'}, "old"),
+        response(200, {"ETag": '"def"'}, "new"),
+    )
+
+    assert session.get("https://example.com/file").text == "old"
+    second = session.get("https://example.com/file")
+    assert second.text == "new"
+    assert not second.from_cache
+
+
+def test_post_is_not_conditional():
+    session = ConditionalSession()
+    sent = mock_server(
+        response(201, {"ETag": '"abc"'}), response(201, {"ETag": '"abc"'})
+    )
+
+    session.post("https://example.com/tokens")
+    session.post("https://example.com/tokens")
+    assert "If-None-Match" not in sent[1][1]
@@ -0,0 +1,100 @@
+"""
+Unit tests for PyPiClient
+"""
+
+import threading
+import time
+
+import pytest
+import requests
+from flexmock import flexmock
+
+from release_bot.exceptions import ReleaseException
+from release_bot.http_cache import ConditionalSession
+from release_bot.pypi import PyPiClient
+
+
+def response(status_code, data=None):
+    return flexmock(status_code=status_code, json=lambda: data, text="")
+
+
+@pytest.fixture
+def client():
+    client = PyPiClient("https://pypi.example.com/pypi/")
+    client.invalidate("project")
+    return client
+
+
+def test_version_exists(client):
+    urls = []
+
+    def get(url, **kwargs):
+        urls.append(url)
+        assert kwargs["timeout"]
+        return response(200 if "1.0.0" in url else 404, {"info": {}})
+
+    flexmock(ConditionalSession).should_receive("get").replace_with(get)
+    assert client.version_exists("project", "1.0.0")
+    assert not client.version_exists("project", "2.0.0")
+    assert client.version_exists("project", "1.0.0")
+    assert urls == [
+        "https://pypi.example.com/pypi/project/1.0.0/json",
+        "https://pypi.example.com/pypi/project/2.0.0/json",
+    ]
+
+
+def test_latest_version(client):
+    flexmock(ConditionalSession).should_receive("get").and_return(
+        response(200, {"info": {"version": "1.2.3"}})
+    ).and_return(response(404)).and_return(response(500))
+    assert client.latest_version("project") == "1.2.3"
+    client.invalidate("project")
+    assert client.latest_version("project") == "0.0.0"
+    client.invalidate("project")
+    with pytest.raises(ReleaseException):
+        client.latest_version("project")
+
+
+def test_concurrent_lookups_deduplicated(client):
+    calls = []
+
+    def get(url, **kwargs):
+        calls.append(url)
+        time.sleep(0.1)
+        return response(200, {"info": {"version": "1.2.3"}})
+
+    flexmock(ConditionalSession).should_receive("get").replace_with(get)
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(client.latest_version("project"))
+        )
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == ["1.2.3"] * 8
+    assert len(calls) == 1
+
+
+def test_expired_results_pruned(client):
+    flexmock(ConditionalSession).should_receive("get").and_return(
+        response(200, {"info": {"version": "1.2.3"}})
+    )
+    expired = PyPiClient("https://pypi.example.com/pypi/", ttl=-1)
+    expired.latest_version("old")
+    old_url = "https://pypi.example.com/pypi/old/json"
+    assert old_url in PyPiClient._results
+
+    client.latest_version("project")
+    assert old_url not in PyPiClient._results
+    assert old_url not in PyPiClient._locks
+    assert "https://pypi.example.com/pypi/project/json" in PyPiClient._results
+
+
+def test_shared_session():
+    session = PyPiClient.get_session()
+    assert isinstance(session, requests.Session)
+    assert PyPiClient("https://test.pypi.org/pypi/").get_session() is session
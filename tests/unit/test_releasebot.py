@@ -0,0 +1,42 @@
+"""
+Unit tests for releasebot module
+"""
+
+import logging
+
+from flexmock import flexmock
+
+from release_bot.exceptions import ReleaseException
+from release_bot.releasebot import ReleaseBot
+
+
+def make_bot(prebuild, checkout=lambda target: True, version_from_git=False):
+    bot = ReleaseBot.__new__(ReleaseBot)
+    bot.logger = logging.getLogger("release-bot")
+    bot.project = flexmock(default_branch="master")
+    bot.git = flexmock(repo_path="/repo", checkout=checkout)
+    bot.pypi = flexmock(
+        prebuild=prebuild, is_version_from_git=lambda path: version_from_git
+    )
+    return bot
+
+
+def test_prebuild_failures_are_only_logged():
+    def prebuild():
+        raise ValueError("InvalidDistribution")
+
+    checkouts = []
+    bot = make_bot(prebuild, checkout=checkouts.append)
+    bot.prebuild_distributions("1.0.0-release")
+    assert checkouts == ["1.0.0-release", "master"]
+
+    def checkout(target):
+        raise ReleaseException(f"Can't checkout {target}")
+
+    make_bot(lambda: True, checkout=checkout).prebuild_distributions("1.0.0-release")
+
+
+def test_no_prebuild_of_version_from_git():
+    bot = make_bot(lambda: True, version_from_git=True)
+    bot.git.should_receive("checkout").never()
+    bot.prebuild_distributions("1.0.0-release")
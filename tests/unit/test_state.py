@@ -0,0 +1,74 @@
+"""
+Unit tests for state module
+"""
+
+import threading
+from datetime import datetime, timezone
+
+from release_bot.github import MergedPR
+from release_bot.state import StateStore, get_state_store
+
+
+def test_processed():
+    state = StateStore()
+    assert not state.is_processed("owner/repo", "issue", 1)
+    state.mark_processed("owner/repo", "issue", 1, "0.1.0")
+    assert state.is_processed("owner/repo", "issue", 1)
+    assert not state.is_processed("owner/repo", "pr", 1)
+    assert not state.is_processed("owner/other", "issue", 1)
+
+
+def test_newest_release_pr():
+    state = StateStore()
+    assert state.get_newest_release_pr("owner/repo") is None
+    old = MergedPR(1, "0.1.0 release", "me", datetime(2020, 1, 1, tzinfo=timezone.utc))
+    new = MergedPR(3, "0.2.0 release", "me", datetime(2020, 2, 1, tzinfo=timezone.utc))
+    state.save_release_pr("owner/repo", new)
+    state.save_release_pr("owner/repo", old)
+    assert state.get_newest_release_pr("owner/repo") == new
+
+
+def test_published_and_watermarks():
+    state = StateStore()
+    state.mark_published("owner/repo", "github", "0.1.0")
+    state.mark_published("owner/repo", "github", "0.1.0")
+    assert state.is_published("owner/repo", "github", "0.1.0")
+    assert not state.is_published("owner/repo", "pypi", "0.1.0")
+
+    assert state.get_watermark("owner/repo", "merged_prs") is None
+    state.set_watermark("owner/repo", "merged_prs", "a")
+    state.set_watermark("owner/repo", "merged_prs", "b")
+    assert state.get_watermark("owner/repo", "merged_prs") == "b"
+
+
+def test_version_files():
+    state = StateStore()
+    assert state.get_version_files("owner/repo") == []
+    state.set_version_files("owner/repo", ["setup.py", "pkg/__init__.py"])
+    state.set_version_files("owner/other", ["setup.cfg"])
+    assert state.get_version_files("owner/repo") == ["pkg/__init__.py", "setup.py"]
+    state.set_version_files("owner/repo", ["pkg/version.py"])
+    assert state.get_version_files("owner/repo") == ["pkg/version.py"]
+
+
+def test_shared_file(tmpdir):
+    path = str(tmpdir / "state.db")
+    assert get_state_store(path) is get_state_store(path)
+
+    # independent connections act like separate worker processes
+    stores = [StateStore(path) for _ in range(4)]
+
+    def work(store, offset):
+        for number in range(offset, offset + 25):
+            store.mark_processed("owner/repo", "issue", number)
+
+    threads = [
+        threading.Thread(target=work, args=(store, index * 25))
+        for index, store in enumerate(stores)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert all(stores[0].is_processed("owner/repo", "issue", n) for n in range(100))